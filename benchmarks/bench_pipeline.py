@@ -0,0 +1,125 @@
+import inspect
+
+import pandas as pd
+import pytest
+
+from load_mobility_trends import load_mobility, read_mobility_csv
+from preprocess_mobility_trends import (
+    CATEGORY_NAMES,
+    melt_mobility_trends,
+    memoize,
+    rename_mobility_trends,
+    subperiod_mobility_trends,
+    subperiods_mobility_trends,
+)
+
+# The preprocessing functions without their instrumentation, and the
+# subperiod step with opt-in memoization for comparison.
+subperiod = inspect.unwrap(subperiod_mobility_trends)
+rename = inspect.unwrap(rename_mobility_trends)
+memoized_subperiod = memoize()(subperiod)
+
+# The subperiod of chapters 05 and 06 and the three UK lockdowns of chapter 01.
+SUBPERIOD = ("2020-02-15", "2021-06-30")
+LOCKDOWNS = {
+    "lockdown1": ("2020-03-24", "2020-04-13"),
+    "lockdown2": ("2020-11-05", "2020-11-25"),
+    "lockdown3": ("2021-01-06", "2021-01-26"),
+}
+COUNTRY = "United Kingdom"
+
+
+@pytest.fixture(scope="session")
+def renamed(mobility_trends):
+    return rename(subperiod(mobility_trends, *SUBPERIOD))
+
+
+# Loading
+# -------
+
+
+@pytest.mark.benchmark(group="load")
+def bench_read_csv(benchmark, scale, report_path):
+    benchmark(pd.read_csv, report_path, parse_dates=["date"])
+
+
+@pytest.mark.benchmark(group="load")
+def bench_read_mobility_csv(benchmark, scale, report_path):
+    benchmark(read_mobility_csv, report_path)
+
+
+@pytest.mark.benchmark(group="load")
+def bench_load_mobility_country(benchmark, scale, store_dir):
+    benchmark(load_mobility, [COUNTRY], store_dir=store_dir)
+
+
+# Preprocessing
+# -------------
+
+
+@pytest.mark.benchmark(group="subperiod")
+def bench_subperiod_mask(benchmark, scale, mobility_trends):
+    dates = pd.date_range(*SUBPERIOD)
+    benchmark(lambda: mobility_trends[mobility_trends["date"].isin(dates)])
+
+
+@pytest.mark.benchmark(group="subperiod")
+def bench_subperiod(benchmark, scale, mobility_trends):
+    benchmark(subperiod, mobility_trends, *SUBPERIOD)
+
+
+@pytest.mark.benchmark(group="subperiod")
+def bench_subperiod_memoized(benchmark, scale, mobility_trends):
+    benchmark(memoized_subperiod, mobility_trends, *SUBPERIOD)
+
+
+@pytest.mark.benchmark(group="rename")
+def bench_rename(benchmark, scale, mobility_trends):
+    benchmark(rename, mobility_trends)
+
+
+@pytest.mark.benchmark(group="rename")
+def bench_rename_no_copy(benchmark, scale, mobility_trends):
+    benchmark(rename, mobility_trends, copy=False)
+
+
+@pytest.mark.benchmark(group="melt")
+def bench_pd_melt(benchmark, scale, renamed):
+    benchmark(
+        pd.melt, renamed, id_vars=["country_region", "date"], value_vars=CATEGORY_NAMES
+    )
+
+
+@pytest.mark.benchmark(group="melt")
+def bench_melt_mobility_trends(benchmark, scale, renamed):
+    benchmark(melt_mobility_trends, renamed, ["country_region", "date"], CATEGORY_NAMES)
+
+
+# Lockdown windows and county means
+# ---------------------------------
+
+
+@pytest.mark.benchmark(group="lockdowns")
+def bench_lockdowns_masks(benchmark, scale, renamed):
+    def lockdowns():
+        windows = [
+            renamed[(renamed["date"] >= start) & (renamed["date"] <= end)]
+            for start, end in LOCKDOWNS.values()
+        ]
+        return pd.concat(windows, keys=list(LOCKDOWNS))
+
+    benchmark(lockdowns)
+
+
+@pytest.mark.benchmark(group="lockdowns")
+def bench_lockdowns(benchmark, scale, renamed):
+    benchmark(subperiods_mobility_trends, renamed, LOCKDOWNS)
+
+
+@pytest.mark.benchmark(group="county means")
+def bench_county_means(benchmark, scale, renamed):
+    def county_means():
+        counties = renamed[renamed["country_region"] == COUNTRY]
+        return counties.groupby("sub_region_1")[CATEGORY_NAMES].mean()
+
+    benchmark(county_means)
@@ -0,0 +1,71 @@
+import glob
+import os
+import sys
+
+import pytest
+
+# The modules under benchmark live next to the notebooks.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "notebooks"))
+
+from generate_mobility_trends import write_mobility_report  # noqa: E402
+from load_mobility_trends import build_mobility_store, read_mobility_csv  # noqa: E402
+
+# Number of synthetic countries at each scale, with 5 regions of 2 districts
+# each over the full 974 days: about 33 thousand, 165 thousand and 660
+# thousand rows.
+SCALES = {"small": 2, "medium": 10, "large": 40}
+
+
+# Results of earlier runs, compared against by each new run.
+STORAGE_DIR = os.path.join(os.path.dirname(__file__), ".benchmarks")
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--scales",
+        default="small,medium",
+        help="comma-separated data scales to benchmark (%s)" % ", ".join(SCALES),
+    )
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config):
+    config.option.benchmark_storage = STORAGE_DIR
+    if not glob.glob(os.path.join(STORAGE_DIR, "*", "*.json")):
+        # First run: nothing to compare with yet.
+        config.option.benchmark_compare = None
+        config.option.benchmark_compare_fail = None
+
+
+def pytest_generate_tests(metafunc):
+    if "scale" in metafunc.fixturenames:
+        scales = metafunc.config.getoption("--scales").split(",")
+        metafunc.parametrize("scale", scales, scope="session")
+
+
+@pytest.fixture(scope="session")
+def report_path(scale, tmp_path_factory):
+    """
+    Path of a synthetic mobility report CSV at the given scale.
+    """
+    path = tmp_path_factory.mktemp("report-%s" % scale) / "report.csv"
+    write_mobility_report(str(path), countries=SCALES[scale], regions=5, sub_regions=2)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def store_dir(report_path):
+    """
+    Partitioned store of the synthetic report.
+    """
+    store_dir = os.path.join(os.path.dirname(report_path), "store")
+    build_mobility_store(report_path, store_dir)
+    return store_dir
+
+
+@pytest.fixture(scope="session")
+def mobility_trends(report_path):
+    """
+    The synthetic report as loaded in the chapters.
+    """
+    return read_mobility_csv(report_path)
@@ -0,0 +1,144 @@
+import numpy as np
+import pandas as pd
+
+# Statistics computed by `grouped_statistics` by default, in the order of
+# `.agg([min, max, np.mean, np.median, np.std])` in chapter 05.
+STATISTICS = ["min", "max", "mean", "median", "std"]
+
+
+def factorize_groups(data, by, dropna=True):
+    """
+    Factorise the group keys of `data` once. Returns the group number of each
+    row, the number of groups and the index of the groups, ordered and
+    labelled as `data.groupby(by, dropna=dropna)` would. Rows with a missing
+    key get the group number -1 unless `dropna=False`.
+    """
+    keys = [by] if isinstance(by, str) else list(by)
+    level_codes, levels, sizes = [], [], []
+    for key in keys:
+        column = data[key]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            codes, level = column.cat.codes.to_numpy(), column.dtype
+            size = len(level.categories)
+        else:
+            codes, level = pd.factorize(column, sort=True)
+            size = len(level)
+        codes = codes.astype(np.int64)
+        if not dropna:
+            # Missing keys form one more group, sorted last.
+            codes[codes < 0] = size
+            size += 1
+        level_codes.append(codes)
+        levels.append(level)
+        sizes.append(size)
+
+    # Number the key combinations in sorted order (mixed radix), then keep
+    # only those that occur.
+    combined = np.zeros(len(data), dtype=np.int64)
+    missing = np.zeros(len(data), dtype=bool)
+    for codes, size in zip(level_codes, sizes):
+        combined = combined * size + codes
+        missing |= codes < 0
+    observed, codes = np.unique(combined[~missing], return_inverse=True)
+    group_codes = np.full(len(data), -1, dtype=np.intp)
+    group_codes[~missing] = codes.ravel()
+
+    arrays = []
+    for level, size in zip(reversed(levels), reversed(sizes)):
+        observed, codes = np.divmod(observed, size)
+        if isinstance(level, pd.CategoricalDtype):
+            codes[codes >= len(level.categories)] = -1
+            arrays.append(pd.Categorical.from_codes(codes, dtype=level))
+        else:
+            arrays.append(level.insert(len(level), np.nan).take(codes))
+    arrays.reverse()
+    if len(keys) == 1:
+        index = pd.Index(arrays[0], name=keys[0])
+    else:
+        index = pd.MultiIndex.from_arrays(arrays, names=keys)
+    return group_codes, len(index), index
+
+
+def _column_statistics(values, codes, n_groups, statistics, quantiles):
+    """
+    Compute `statistics` and `quantiles` of `values` for each group in one
+    sweep over the values sorted by group.
+    """
+    keep = codes >= 0
+    values, codes = values[keep], codes[keep]
+    # One sort by group, then value; NaNs sort last within each group.
+    order = np.lexsort((values, codes))
+    values = values[order]
+    sizes = np.bincount(codes, minlength=n_groups)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    segment = np.repeat(np.arange(n_groups), sizes)
+    counts = np.bincount(segment, weights=~np.isnan(values), minlength=n_groups)
+    present = counts > 0
+
+    def at(positions):
+        # Values at positions within the non-missing values of each group.
+        result = np.full(n_groups, np.nan)
+        result[present] = values[(starts + positions)[present]]
+        return result
+
+    def quantile(q):
+        # Linear interpolation between the closest ranks, as pandas does.
+        rank = q * np.maximum(counts - 1, 0)
+        below = np.floor(rank).astype(np.intp)
+        above = np.minimum(below + 1, np.maximum(counts - 1, 0).astype(np.intp))
+        return at(below) + (at(above) - at(below)) * (rank - below)
+
+    filled = np.where(np.isnan(values), 0, values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(segment, weights=filled, minlength=n_groups) / counts
+        # Squared deviations from the group mean (two passes, which is as
+        # stable as Welford's running update and vectorises).
+        deviations = np.where(np.isnan(values), 0, values - mean[segment])
+        squares = np.bincount(segment, weights=deviations**2, minlength=n_groups)
+        std = np.sqrt(squares / (counts - 1))
+    std[counts < 2] = np.nan
+
+    computed = {
+        "count": counts,
+        "min": at(np.zeros(n_groups, np.intp)),
+        "max": at(np.maximum(counts - 1, 0).astype(np.intp)),
+        "mean": mean,
+        "median": quantile(0.5),
+        "std": std,
+        "sum": np.bincount(segment, weights=filled, minlength=n_groups),
+    }
+    result = {name: computed[name] for name in statistics}
+    for q in quantiles:
+        result["%g%%" % (100 * q)] = quantile(q)
+    return result
+
+
+def grouped_statistics(data, by, columns="value", statistics=STATISTICS, quantiles=()):
+    """
+    Compute several statistics of `columns` for each group of `data`, like
+    `data.groupby(by)[columns].agg([min, max, np.mean, np.median, np.std])`.
+
+    The group keys are factorised once and each column is sorted once (by
+    group, then value), after which every statistic is read off the
+    contiguous group segments: min and max at their ends, medians and
+    `quantiles` (e.g. `[0.25, 0.75]`) by interpolating between ranks, sums,
+    means and standard deviations by segment sums. `statistics` are any of
+    "count", "min", "max", "mean", "median", "std" and "sum". Missing values
+    are skipped, and `std` has one degree of freedom removed, as in pandas.
+
+    With a single column name the result has one column per statistic;
+    with a list of columns, its columns are (column, statistic) pairs.
+    """
+    codes, n_groups, index = factorize_groups(data, by)
+    if isinstance(columns, str):
+        values = data[columns].to_numpy(np.float64, na_value=np.nan)
+        result = _column_statistics(values, codes, n_groups, statistics, quantiles)
+        return pd.DataFrame(result, index=index)
+    results = {}
+    for column in columns:
+        values = data[column].to_numpy(np.float64, na_value=np.nan)
+        for name, value in _column_statistics(
+            values, codes, n_groups, statistics, quantiles
+        ).items():
+            results[(column, name)] = value
+    return pd.DataFrame(results, index=index)
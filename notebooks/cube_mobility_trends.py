@@ -0,0 +1,203 @@
+import json
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from preprocess_mobility_trends import CATEGORY_COLUMNS, MOBILITY_SCHEMA
+
+# Columns that together identify one region (one time series) of the data.
+REGION_COLUMNS = ["country_region", "sub_region_1", "sub_region_2", "metro_area"]
+
+
+class MobilityCube:
+    """
+    Dense region × date × category array of the mobility data.
+
+    `values[r, d, c]` holds the change from baseline of category `c` for region
+    `r` on day `d` (NaN where the data has no value). Regions of the same
+    country are stored next to each other, so a country, a date window or a
+    category is a basic NumPy slice, i.e. a view that copies no data. When the
+    cube is saved to disk, `values` is a memory-mapped array.
+    """
+
+    def __init__(self, values, regions, start_date, categories=CATEGORY_COLUMNS):
+        self.values = values
+        self.regions = regions
+        self.start_date = pd.Timestamp(start_date)
+        self.categories = list(categories)
+        self.dates = pd.date_range(self.start_date, periods=values.shape[1])
+
+        # Lookup tables from names to integer offsets.
+        self._countries = {}
+        for position, country in enumerate(regions["country_region"]):
+            start, _ = self._countries.get(country, (position, position))
+            self._countries[country] = (start, position + 1)
+        self._regions = {
+            tuple(None if pd.isna(v) else v for v in key): position
+            for position, key in enumerate(regions.itertuples(index=False))
+        }
+
+    @classmethod
+    def build(cls, data, path=None, categories=None):
+        """
+        Build a cube from the mobility data in `data` (in long, one row per
+        region and day, format).
+
+        If `path` is given the cube is written to that directory as a
+        memory-mapped `.npy` file and can be reopened with `MobilityCube.open`.
+        By default the cube holds the six mobility categories, under the raw or
+        short names they have in `data`.
+        """
+        if categories is None:
+            categories = MOBILITY_SCHEMA.category_labels(data)
+        keys = data[REGION_COLUMNS]
+        region_codes = keys.groupby(
+            REGION_COLUMNS, sort=False, dropna=False, observed=True
+        ).ngroup()
+        regions = keys.drop_duplicates().reset_index(drop=True)
+
+        # Keep the regions of each country together, in order of appearance.
+        country_rank = pd.factorize(regions["country_region"])[0]
+        order = np.argsort(country_rank, kind="stable")
+        regions = regions.iloc[order].reset_index(drop=True)
+        new_position = np.empty_like(order)
+        new_position[order] = np.arange(len(order))
+        region_codes = new_position[region_codes.to_numpy()]
+
+        start_date = data["date"].min()
+        day_codes = (data["date"] - start_date).dt.days.to_numpy()
+        shape = (len(regions), int(day_codes.max()) + 1, len(categories))
+
+        if path is None:
+            values = np.full(shape, np.nan, dtype=np.float32)
+        else:
+            os.makedirs(path, exist_ok=True)
+            values = np.lib.format.open_memmap(
+                os.path.join(path, "values.npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=shape,
+            )
+            values[:] = np.nan
+        values[region_codes, day_codes, :] = data[categories].to_numpy(np.float32)
+
+        cube = cls(values, regions, start_date, categories)
+        if path is not None:
+            values.flush()
+            cube._save_tables(path)
+        return cube
+
+    def _save_tables(self, path):
+        regions = self.regions.astype(object).where(self.regions.notna(), None)
+        with open(os.path.join(path, "cube.json"), "w") as f:
+            json.dump(
+                {
+                    "start_date": self.start_date.strftime("%Y-%m-%d"),
+                    "categories": self.categories,
+                    "region_columns": list(self.regions.columns),
+                    "regions": regions.values.tolist(),
+                },
+                f,
+            )
+
+    @classmethod
+    def open(cls, path, mode="r"):
+        """
+        Open the cube saved in the directory `path` without reading its values.
+        """
+        with open(os.path.join(path, "cube.json")) as f:
+            tables = json.load(f)
+        values = np.load(os.path.join(path, "values.npy"), mmap_mode=mode)
+        regions = pd.DataFrame(tables["regions"], columns=tables["region_columns"])
+        return cls(values, regions, tables["start_date"], tables["categories"])
+
+    def country_slice(self, country_region):
+        """
+        Return the slice of region offsets of the country `country_region`.
+        """
+        return slice(*self._countries[country_region])
+
+    def region_offset(
+        self, country_region, sub_region_1=None, sub_region_2=None, metro_area=None
+    ):
+        """
+        Return the offset of a single region; omitted levels mean the
+        country-level (or sub-region-level) series.
+        """
+        return self._regions[(country_region, sub_region_1, sub_region_2, metro_area)]
+
+    def date_slice(self, start_date=None, end_date=None):
+        """
+        Return the slice of date offsets between `start_date` and `end_date`
+        (both included).
+        """
+        start = 0 if start_date is None else self.date_offset(start_date)
+        end = len(self.dates) - 1 if end_date is None else self.date_offset(end_date)
+        return slice(max(start, 0), max(end + 1, 0))
+
+    def date_offset(self, date):
+        """
+        Return the offset of `date` along the date axis.
+        """
+        return (pd.Timestamp(date) - self.start_date).days
+
+    def category_offset(self, category):
+        """
+        Return the offset of `category` (a raw or short name) along the
+        category axis.
+        """
+        if category not in self.categories:
+            schema = MOBILITY_SCHEMA
+            category = schema.short_names.get(category, schema.raw_names.get(category))
+        return self.categories.index(category)
+
+    def select(
+        self, country_region=None, start_date=None, end_date=None, category=None
+    ):
+        """
+        Return a view of the values of one country, one date window and/or one
+        category. Omitted arguments select everything along that axis.
+        """
+        regions = (
+            slice(None)
+            if country_region is None
+            else self.country_slice(country_region)
+        )
+        dates = self.date_slice(start_date, end_date)
+        if category is None:
+            return self.values[regions, dates, :]
+        return self.values[regions, dates, self.category_offset(category)]
+
+    def region_means(self, country_region=None, start_date=None, end_date=None):
+        """
+        Mean of each category for each region over a date window, as a
+        DataFrame indexed like `regions`.
+        """
+        regions = (
+            slice(None)
+            if country_region is None
+            else self.country_slice(country_region)
+        )
+        values = self.select(country_region, start_date, end_date)
+        with warnings.catch_warnings():
+            # Regions or days without any value have a NaN mean.
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            means = np.nanmean(values, axis=1)
+        return pd.DataFrame(
+            means, index=self.regions.index[regions], columns=self.categories
+        )
+
+    def date_means(self, country_region=None, start_date=None, end_date=None):
+        """
+        Mean of each category on each day over the regions of a country (or of
+        all countries), as a DataFrame indexed by date.
+        """
+        dates = self.date_slice(start_date, end_date)
+        values = self.select(country_region, start_date, end_date)
+        with warnings.catch_warnings():
+            # Regions or days without any value have a NaN mean.
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            means = np.nanmean(values, axis=0)
+        return pd.DataFrame(means, index=self.dates[dates], columns=self.categories)
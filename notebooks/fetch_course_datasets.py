@@ -0,0 +1,186 @@
+import argparse
+import concurrent.futures
+import http.server
+import os
+import shutil
+import socket
+import threading
+import time
+import urllib.error
+
+import pandas as pd
+
+from load_mobility_trends import MOBILITY_REPORT_URL, fetch_cached
+
+# The remote CSV files loaded in the chapters, with the `pd.read_csv`
+# arguments each chapter uses.
+COURSE_DATASETS = {
+    "mobility_trends": {
+        "url": MOBILITY_REPORT_URL,
+        "read_csv": {"parse_dates": ["date"]},
+    },
+    "owid_covid": {
+        "url": "https://covid.ourworldindata.org/data/owid-covid-data.csv",
+        "read_csv": {},
+    },
+    "apple_mobility_trends": {
+        "url": "https://raw.githubusercontent.com/ActiveConclusion/COVID19_mobility/master/apple_reports/applemobilitytrends.csv",
+        "read_csv": {},
+    },
+    "star_wars_network": {
+        "url": "https://raw.githubusercontent.com/valdanchev/reproducible-data-science-python/master/data/star-wars-network.csv",
+        "read_csv": {},
+    },
+}
+
+
+def _dataset_url(name, base_url):
+    url = COURSE_DATASETS[name]["url"]
+    if base_url is None:
+        return url
+    return base_url.rstrip("/") + "/" + os.path.basename(url)
+
+
+def _is_transient(error):
+    # Other OSErrors, such as the FileNotFoundError of an offline cache miss,
+    # fail the same way on every attempt.
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(
+        error, (urllib.error.URLError, ConnectionError, socket.timeout, TimeoutError)
+    )
+
+
+def fetch_dataset(name, base_url=None, retries=3, backoff=1.0, **kwargs):
+    """
+    Return the local path of a cached copy of the course dataset `name`.
+
+    Transient failures (connection errors, HTTP 429 and 5xx) are retried up to
+    `retries` times, waiting `backoff`, 2 × `backoff`, ... seconds in between.
+    With `base_url` the file is fetched from that server (for example one
+    started by `serve_fixtures`) instead of its original location. Extra
+    keyword arguments are passed on to `fetch_cached`.
+    """
+    url = _dataset_url(name, base_url)
+    for attempt in range(retries + 1):
+        try:
+            return fetch_cached(url, **kwargs)
+        except Exception as error:
+            if attempt == retries or not _is_transient(error):
+                raise
+            time.sleep(backoff * 2**attempt)
+
+
+def load_dataset(name, base_url=None, retries=3, backoff=1.0, **kwargs):
+    """
+    Fetch (through the cache) and parse the course dataset `name`.
+    """
+    path = fetch_dataset(name, base_url, retries, backoff, **kwargs)
+    return pd.read_csv(path, **COURSE_DATASETS[name]["read_csv"])
+
+
+def load_course_datasets(
+    names=None, workers=4, base_url=None, retries=3, backoff=1.0, **kwargs
+):
+    """
+    Fetch and parse several course datasets concurrently.
+
+    `names` defaults to all of `COURSE_DATASETS`. Each dataset is downloaded,
+    cached and parsed in its own worker thread, so the total time is set by
+    the slowest source rather than by the sum of all of them. Returns a
+    dictionary from dataset name to DataFrame. See `fetch_dataset` for the
+    other arguments.
+    """
+    names = list(COURSE_DATASETS) if names is None else list(names)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            name: executor.submit(
+                load_dataset, name, base_url, retries, backoff, **kwargs
+            )
+            for name in names
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+# Local fixture server
+# --------------------
+# Serves recorded copies of the datasets over HTTP, with the same ETag and
+# Last-Modified validators as a real server, so that the loaders can be tested
+# and benchmarked without network access.
+
+
+class _FixtureHandler(http.server.SimpleHTTPRequestHandler):
+    def send_head(self):
+        path = self.translate_path(self.path)
+        self._etag = None
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            self._etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+            if self.headers.get("If-None-Match") == self._etag:
+                self.send_response(304)
+                self.end_headers()
+                return None
+        return super().send_head()
+
+    def end_headers(self):
+        if getattr(self, "_etag", None) is not None:
+            self.send_header("ETag", self._etag)
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_fixtures(directory, port=0):
+    """
+    Serve the files in `directory` over HTTP from a background thread.
+
+    Returns the server and its base URL, to be passed as `base_url` to the
+    loaders. Call `server.shutdown()` to stop it.
+    """
+
+    def handler(*args, **kwargs):
+        return _FixtureHandler(*args, directory=directory, **kwargs)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, "http://127.0.0.1:%d" % server.server_address[1]
+
+
+def record_fixtures(directory, names=None, **kwargs):
+    """
+    Copy the cached course datasets into `directory` so that `serve_fixtures`
+    can serve them.
+    """
+    names = list(COURSE_DATASETS) if names is None else list(names)
+    os.makedirs(directory, exist_ok=True)
+    for name in names:
+        url = COURSE_DATASETS[name]["url"]
+        shutil.copyfile(
+            fetch_dataset(name, **kwargs),
+            os.path.join(directory, os.path.basename(url)),
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve recorded copies of the course datasets."
+    )
+    parser.add_argument("directory")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="copy the cached datasets into the directory first",
+    )
+    arguments = parser.parse_args()
+    if arguments.record:
+        record_fixtures(arguments.directory)
+    server, base_url = serve_fixtures(arguments.directory, arguments.port)
+    print("Serving %s at %s" % (arguments.directory, base_url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
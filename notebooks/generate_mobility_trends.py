@@ -0,0 +1,274 @@
+import argparse
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from load_mobility_trends import build_mobility_store
+from preprocess_mobility_trends import CATEGORY_COLUMNS, GEOGRAPHY_COLUMNS
+
+# A few real countries come first so that the filters used in the chapters
+# (e.g. `country_region == "United Kingdom"`) also work on synthetic data.
+COUNTRIES = [
+    ("DE", "Germany"),
+    ("ES", "Spain"),
+    ("FR", "France"),
+    ("GB", "United Kingdom"),
+    ("IT", "Italy"),
+    ("SE", "Sweden"),
+]
+
+START_DATE = "2020-02-15"
+END_DATE = "2022-10-15"
+
+# Roughly the shape of the final Google report: 135 countries with, on
+# average, 14 first-level regions of 3 second-level regions each, observed
+# for 974 days (about 7.5 million rows).
+REPORT_SHAPE = {"countries": 135, "regions": 14, "sub_regions": 3}
+
+# Lockdown-shaped dips: start, end and depth (as a fraction of the deepest dip).
+LOCKDOWNS = [
+    ("2020-03-23", "2020-05-31", 1.0),
+    ("2020-11-05", "2020-12-02", 0.6),
+    ("2021-01-06", "2021-03-29", 0.8),
+]
+
+# How each category reacts to a lockdown (in percent change from baseline at
+# the deepest point), and how strongly it rises at weekends.
+CATEGORY_RESPONSE = np.array([-75.0, -35.0, -45.0, -70.0, -65.0, 25.0])
+WEEKEND_EFFECT = np.array([5.0, -5.0, 15.0, 5.0, 25.0, -8.0])
+
+# Share of regions missing each category entirely, and of single days missing.
+MISSING_SERIES = np.array([0.05, 0.08, 0.4, 0.3, 0.02, 0.25])
+MISSING_DAYS = 0.03
+
+
+def _places_per_country(regions, sub_regions):
+    # The country and its metro area, then each region and its sub-regions.
+    return 2 + regions * (1 + sub_regions)
+
+
+def report_scale(shape):
+    """
+    Return how many times as many rows as `REPORT_SHAPE` the report of
+    `shape` has.
+    """
+    rows = shape["countries"] * _places_per_country(
+        shape["regions"], shape["sub_regions"]
+    )
+    base = REPORT_SHAPE["countries"] * _places_per_country(
+        REPORT_SHAPE["regions"], REPORT_SHAPE["sub_regions"]
+    )
+    return rows / base
+
+
+def mobility_report_shape(scale=1):
+    """
+    Return the number of countries, regions per country and sub-regions per
+    region that give as close to `scale` times as many rows as the Google
+    report as whole numbers allow (`report_scale` gives the achieved factor).
+
+    Below 1 fewer countries are generated. Above 1 the countries are kept and
+    both regions and sub-regions grow, by about the square root of `scale`
+    each, so that the places per country grow by `scale`.
+    """
+    shape = dict(REPORT_SHAPE)
+    if scale < 1:
+        shape["countries"] = max(1, int(round(shape["countries"] * scale)))
+        return shape
+
+    target = scale * _places_per_country(shape["regions"], shape["sub_regions"])
+    candidates = []
+    for sub_regions in range(1, int(target) + 1):
+        regions = max(1, int(round((target - 2) / (1 + sub_regions))))
+        error = abs(_places_per_country(regions, sub_regions) - target)
+        # Among equally close shapes, grow regions and sub-regions evenly.
+        balance = abs(
+            np.log(regions / REPORT_SHAPE["regions"])
+            - np.log(sub_regions / REPORT_SHAPE["sub_regions"])
+        )
+        candidates.append((error, balance, regions, sub_regions))
+    _, _, shape["regions"], shape["sub_regions"] = min(candidates)
+    return shape
+
+
+_LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+# Two-letter codes for the synthetic countries, avoiding the real ones above
+# and "NA", which `pd.read_csv` parses as a missing value.
+_SYNTHETIC_CODES = [
+    a + b
+    for a in _LETTERS
+    for b in _LETTERS
+    if a + b not in {code for code, _ in COUNTRIES} | {"NA"}
+]
+
+
+def _country(position):
+    if position < len(COUNTRIES):
+        return COUNTRIES[position]
+    return _SYNTHETIC_CODES[position - len(COUNTRIES)], "Country %03d" % position
+
+
+def _place_id(*names):
+    key = "/".join(str(name) for name in names)
+    return "ChIJ" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:23]
+
+
+def _country_places(position, regions, sub_regions):
+    """
+    Return the geographic columns of every region of one country.
+    """
+    code, country = _country(position)
+    places = [(country, None, None, None, None)]
+    places.append((country, None, None, "%s Metropolitan Area" % country, None))
+    for region in range(1, regions + 1):
+        region_name = "%s Region %02d" % (country, region)
+        places.append((country, region_name, None, None, "%s-%02d" % (code, region)))
+        for sub_region in range(1, sub_regions + 1):
+            sub_region_name = "%s District %02d-%02d" % (country, region, sub_region)
+            places.append((country, region_name, sub_region_name, None, None))
+
+    places = pd.DataFrame(
+        places,
+        columns=[
+            "country_region",
+            "sub_region_1",
+            "sub_region_2",
+            "metro_area",
+            "iso_3166_2_code",
+        ],
+    )
+    places.insert(0, "country_region_code", code)
+    places["census_fips_code"] = np.nan
+    places["place_id"] = [
+        _place_id(*place)
+        for place in places[["country_region", "sub_region_1", "sub_region_2"]]
+        .fillna("")
+        .itertuples(index=False)
+    ]
+    return places[GEOGRAPHY_COLUMNS]
+
+
+def _lockdown_shape(dates, rng):
+    """
+    Return the depth (0 to 1) of the lockdown dip on each date: a quick drop
+    over a week, a plateau and a slow recovery after the lockdown ends.
+    """
+    days = np.asarray((dates - dates[0]).days)
+    depth = np.zeros(len(dates))
+    for start, end, strength in LOCKDOWNS:
+        start = (pd.Timestamp(start) - dates[0]).days + rng.integers(-7, 8)
+        end = (pd.Timestamp(end) - dates[0]).days + rng.integers(-7, 8)
+        strength *= rng.uniform(0.6, 1.1)
+        drop = np.clip((days - start) / 7, 0, 1)
+        recovery = np.where(days > end, np.exp(-(days - end) / 30), 1)
+        depth = np.maximum(depth, strength * drop * recovery)
+    return depth
+
+
+def generate_country(position, regions, sub_regions, dates, rng):
+    """
+    Generate the mobility data of one country, one row per region and date,
+    with the same columns and dtypes as the Google report.
+    """
+    places = _country_places(position, regions, sub_regions)
+    n_places, n_dates = len(places), len(dates)
+
+    depth = _lockdown_shape(dates, rng)
+    weekend = np.asarray(dates.dayofweek) >= 5
+    seasonal = np.sin(2 * np.pi * (np.asarray(dates.dayofyear) - 100) / 365)
+
+    values = (
+        depth[None, :, None]
+        * CATEGORY_RESPONSE
+        * rng.uniform(0.7, 1.2, (n_places, 1, 6))
+        + weekend[None, :, None] * WEEKEND_EFFECT
+        + rng.normal(0, 6, (n_places, n_dates, 6))
+    )
+    # Park visits follow the seasons.
+    values[:, :, 2] += 40 * seasonal[None, :] * rng.uniform(0.5, 1.5, (n_places, 1))
+    values = np.round(values)
+
+    # Smaller regions miss whole categories more often than countries do.
+    size = np.where(places["sub_region_2"].notna(), 1.0, 0.3)[:, None]
+    missing_series = rng.random((n_places, 6)) < MISSING_SERIES * size
+    values[np.broadcast_to(missing_series[:, None, :], values.shape)] = np.nan
+    values[rng.random(values.shape) < MISSING_DAYS] = np.nan
+
+    data = places.loc[places.index.repeat(n_dates)].reset_index(drop=True)
+    data["date"] = np.tile(dates.to_numpy(), n_places)
+    for category, column in enumerate(CATEGORY_COLUMNS):
+        data[column] = values[:, :, category].ravel()
+    return data
+
+
+def iter_mobility_report(
+    countries=None,
+    regions=None,
+    sub_regions=None,
+    start_date=START_DATE,
+    end_date=END_DATE,
+    scale=1,
+    seed=0,
+):
+    """
+    Generate a synthetic Global Mobility Report country by country.
+
+    By default the shape of the data follows `mobility_report_shape(scale)`;
+    `countries`, `regions` (first-level regions per country) and
+    `sub_regions` (second-level regions per region) override it. Yields one
+    DataFrame per country, so that reports larger than memory can be written.
+    """
+    shape = mobility_report_shape(scale)
+    countries = shape["countries"] if countries is None else countries
+    regions = shape["regions"] if regions is None else regions
+    sub_regions = shape["sub_regions"] if sub_regions is None else sub_regions
+    dates = pd.date_range(start_date, end_date)
+    rng = np.random.default_rng(seed)
+    for position in range(countries):
+        yield generate_country(position, regions, sub_regions, dates, rng)
+
+
+def generate_mobility_report(**kwargs):
+    """
+    Generate a synthetic Global Mobility Report as a single DataFrame. See
+    `iter_mobility_report` for the arguments.
+    """
+    return pd.concat(iter_mobility_report(**kwargs), ignore_index=True)
+
+
+def write_mobility_report(path, store_dir=None, **kwargs):
+    """
+    Write a synthetic Global Mobility Report to the CSV file at `path`, and
+    convert it into a partitioned store in `store_dir` if given. See
+    `iter_mobility_report` for the other arguments.
+    """
+    header = True
+    for data in iter_mobility_report(**kwargs):
+        data.to_csv(path, mode="w" if header else "a", header=header, index=False)
+        header = False
+    if store_dir is not None:
+        build_mobility_store(path, store_dir)
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic Global Mobility Report."
+    )
+    parser.add_argument("path")
+    parser.add_argument("--scale", type=float, default=1)
+    parser.add_argument("--store-dir")
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+    print(
+        "Writing %.3g times the rows of the Google report"
+        % report_scale(mobility_report_shape(arguments.scale))
+    )
+    write_mobility_report(
+        arguments.path,
+        store_dir=arguments.store_dir,
+        scale=arguments.scale,
+        seed=arguments.seed,
+    )
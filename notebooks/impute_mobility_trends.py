@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+
+from aggregate_mobility_trends import factorize_groups
+from cube_mobility_trends import REGION_COLUMNS
+from load_mobility_trends import date_ordinals
+from preprocess_mobility_trends import MOBILITY_SCHEMA
+
+IMPUTATION_STRATEGIES = ["mean", "weekday_mean", "interpolate", "ffill"]
+
+
+def _fill_with_means(values, keys, n_keys):
+    """
+    Fill the NaNs of `values` with the mean of the non-missing values of the
+    same key.
+    """
+    missing = np.isnan(values)
+    sums = np.bincount(keys, weights=np.where(missing, 0, values), minlength=n_keys)
+    counts = np.bincount(keys, weights=~missing, minlength=n_keys)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    return np.where(missing, means[keys], values)
+
+
+def _neighbours(valid, codes):
+    """
+    For each position of the sorted series, return the positions of the
+    last and of the next valid value of the same region (-1 if none).
+    """
+    positions = np.arange(len(valid))
+    previous = np.maximum.accumulate(np.where(valid, positions, -1))
+    following = np.where(valid, positions, len(valid))
+    following = np.minimum.accumulate(following[::-1])[::-1]
+    previous[(previous < 0) | (codes[np.maximum(previous, 0)] != codes)] = -1
+    outside = (following == len(valid)) | (
+        codes[np.minimum(following, len(valid) - 1)] != codes
+    )
+    following[outside] = -1
+    return previous, following
+
+
+def _fill_series(values, codes, days, strategy, limit):
+    """
+    Fill the NaNs of `values`, sorted by region and date, from the values
+    before and after them in the same region.
+    """
+    valid = ~np.isnan(values)
+    previous, following = _neighbours(valid, codes)
+    filled = values.copy()
+    if strategy == "ffill":
+        fill = ~valid & (previous >= 0)
+        if limit is not None:
+            fill &= np.arange(len(values)) - previous <= limit
+        filled[fill] = values[previous[fill]]
+        return filled
+
+    # Linear in time between the closest values on either side.
+    fill = ~valid & (previous >= 0) & (following >= 0)
+    before, after = previous[fill], following[fill]
+    weight = (days[fill] - days[before]) / (days[after] - days[before])
+    filled[fill] = values[before] + (values[after] - values[before]) * weight
+    return filled
+
+
+def impute_mobility_trends(
+    data, strategy="interpolate", columns=None, limit=None, by=REGION_COLUMNS
+):
+    """
+    Fill the missing values of the mobility categories in `data` region by
+    region, and return the filled copy.
+
+    `strategy` is one of
+    - "mean": the mean of the category in the region;
+    - "weekday_mean": the mean of the category in the region on the same day
+      of the week;
+    - "interpolate": linear interpolation in time between the closest values
+      of the region's series (gaps at either end are left missing);
+    - "ffill": the last earlier value of the region's series, at most `limit`
+      rows back if given.
+
+    Regions are told apart by the columns in `by`, and `columns` defaults to
+    the six mobility categories. The regions are factorised once and every
+    strategy is computed for all regions at once on the series sorted by
+    region and date, without `groupby().apply`.
+    """
+    if strategy not in IMPUTATION_STRATEGIES:
+        raise ValueError("Unknown imputation strategy: %r" % (strategy,))
+    if columns is None:
+        columns = MOBILITY_SCHEMA.category_labels(data)
+    codes, n_regions, _ = factorize_groups(data, by, dropna=False)
+    days = date_ordinals(data["date"]).astype(np.int64)
+
+    result = data.copy()
+    if strategy in ("mean", "weekday_mean"):
+        keys, n_keys = codes, n_regions
+        if strategy == "weekday_mean":
+            # 1970-01-01, day 0, was a Thursday (weekday 3).
+            keys, n_keys = codes * 7 + (days + 3) % 7, n_regions * 7
+        for column in columns:
+            values = data[column].to_numpy(np.float64, na_value=np.nan)
+            result[column] = _fill_with_means(values, keys, n_keys)
+        return result
+
+    order = np.lexsort((days, codes))
+    for column in columns:
+        values = data[column].to_numpy(np.float64, na_value=np.nan)[order]
+        filled = np.empty_like(values)
+        filled[order] = _fill_series(values, codes[order], days[order], strategy, limit)
+        result[column] = filled
+    return result
+
+
+def impute_mobility_chunks(chunks, strategy="interpolate", by=REGION_COLUMNS, **kwargs):
+    """
+    Impute the mobility data given as an iterable of DataFrames (e.g. the
+    chunks of `read_mobility_csv(..., chunksize=...)`), yielding the filled
+    chunks.
+
+    The rows of each region must be contiguous, as in the Google report: the
+    rows of the last region of a chunk are held back and imputed with the
+    next chunk, so every region is imputed whole. See
+    `impute_mobility_trends` for the other arguments.
+    """
+    held = None
+    for chunk in chunks:
+        if held is not None:
+            chunk = pd.concat([held, chunk])
+        codes, _, _ = factorize_groups(chunk, by, dropna=False)
+        # Start of the run of rows of the last region.
+        others = np.flatnonzero(codes != codes[-1])
+        start = others[-1] + 1 if len(others) else 0
+        held = chunk.iloc[start:]
+        if start > 0:
+            yield impute_mobility_trends(chunk.iloc[:start], strategy, by=by, **kwargs)
+    if held is not None and len(held):
+        yield impute_mobility_trends(held, strategy, by=by, **kwargs)
@@ -0,0 +1,195 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from cube_mobility_trends import REGION_COLUMNS
+from load_mobility_trends import (
+    MOBILITY_REPORT_URL,
+    fetch_cached,
+    file_fingerprint,
+    fingerprint_matches,
+    read_mobility_csv,
+)
+from preprocess_mobility_trends import MOBILITY_DTYPES
+
+
+class RegionIndex:
+    """
+    Row positions of every node of the region hierarchy of the mobility data
+    (country_region → sub_region_1 → sub_region_2 → metro_area).
+
+    A node is a tuple of the first levels of a region key, e.g.
+    `("United Kingdom",)` for all rows of the UK or `("United Kingdom",
+    "Essex")` for all rows of Essex and its districts; `None` stands for a
+    missing level, so `("United Kingdom", None, None, None)` is the
+    country-level series only. The rows of a node are stored as a range of
+    positions when they are contiguous (as they are in the Google report) and
+    as a sorted array of positions otherwise, so selecting a node costs one
+    dictionary lookup instead of a scan of the whole frame.
+    """
+
+    def __init__(self, keys, starts, stops, scattered, positions, n_rows):
+        self.keys = [tuple(key) for key in keys]
+        # Node i holds the rows starts[i]:stops[i], or, if scattered[i], the
+        # rows positions[starts[i]:stops[i]].
+        self.starts = starts
+        self.stops = stops
+        self.scattered = scattered
+        self.positions = positions
+        self.n_rows = n_rows
+        self._nodes = {key: node for node, key in enumerate(self.keys)}
+
+    @classmethod
+    def build(cls, data):
+        """
+        Build the index of the rows of `data`, which has the columns of
+        `REGION_COLUMNS`.
+        """
+        keys, starts, stops, scattered, positions = [], [], [], [], []
+        n_positions = 0
+        for depth in range(1, len(REGION_COLUMNS) + 1):
+            columns = REGION_COLUMNS[:depth]
+            groups = (
+                data[columns]
+                .groupby(columns, sort=False, dropna=False, observed=True)
+                .ngroup()
+                .to_numpy()
+            )
+            order = np.argsort(groups, kind="stable")
+            bounds = np.concatenate([[0], np.cumsum(np.bincount(groups))])
+            firsts = order[bounds[:-1]]
+            lasts = order[bounds[1:] - 1]
+            contiguous = lasts - firsts + 1 == np.diff(bounds)
+
+            for row in data[columns].iloc[firsts].itertuples(index=False):
+                keys.append(tuple(None if pd.isna(value) else value for value in row))
+            # Scattered nodes point into one array of positions instead.
+            sizes = np.where(contiguous, 0, np.diff(bounds))
+            ends = n_positions + np.cumsum(sizes)
+            starts.append(np.where(contiguous, firsts, ends - sizes))
+            stops.append(np.where(contiguous, lasts + 1, ends))
+            scattered.append(~contiguous)
+            for node in np.flatnonzero(~contiguous):
+                positions.append(order[bounds[node] : bounds[node + 1]])
+            n_positions += sizes.sum()
+
+        return cls(
+            keys,
+            np.concatenate(starts),
+            np.concatenate(stops),
+            np.concatenate(scattered),
+            np.concatenate(positions) if positions else np.array([], dtype=np.intp),
+            len(data),
+        )
+
+    def save(self, path, **metadata):
+        """
+        Write the index to the `.npz` file `path`, with `metadata` (e.g. the
+        SHA-256 of the data it indexes).
+        """
+        # Keys and metadata are stored as JSON text rather than pickled objects.
+        np.savez(
+            path,
+            keys=np.array(json.dumps(self.keys)),
+            metadata=np.array(json.dumps(dict(metadata, n_rows=self.n_rows))),
+            starts=self.starts,
+            stops=self.stops,
+            scattered=self.scattered,
+            positions=self.positions,
+        )
+
+    @classmethod
+    def open(cls, path):
+        """
+        Read the index saved in the `.npz` file `path`, and its metadata.
+        """
+        with np.load(path) as arrays:
+            metadata = json.loads(str(arrays["metadata"]))
+            index = cls(
+                json.loads(str(arrays["keys"])),
+                arrays["starts"],
+                arrays["stops"],
+                arrays["scattered"],
+                arrays["positions"],
+                metadata["n_rows"],
+            )
+        return index, metadata
+
+    def locate(self, *key):
+        """
+        Return the positions of the rows of the node `key`: a slice when they
+        are contiguous, a sorted array otherwise.
+        """
+        node = self._nodes.get(key)
+        if node is None:
+            return slice(0, 0)
+        rows = slice(int(self.starts[node]), int(self.stops[node]))
+        if self.scattered[node]:
+            return self.positions[rows]
+        return rows
+
+    def select(self, data, *key):
+        """
+        Return the rows of `data` in the node `key`, e.g.
+        `index.select(data, "United Kingdom", "Essex")`. `data` must be the
+        DataFrame the index was built from.
+        """
+        if len(data) != self.n_rows:
+            raise ValueError(
+                "The index covers %d rows, not %d" % (self.n_rows, len(data))
+            )
+        return data.iloc[self.locate(*key)]
+
+    def children(self, *key):
+        """
+        Return the keys of the nodes one level below `key`.
+        """
+        return [
+            child
+            for child in self.keys
+            if len(child) == len(key) + 1 and child[: len(key)] == key
+        ]
+
+
+def _region_index_path(source):
+    return source + ".regions.npz"
+
+
+def load_region_index(source, data=None, sha256=None):
+    """
+    Return the region index of the mobility report CSV at `source`.
+
+    The index saved next to the file is reused if it was built for the same
+    content (see `fingerprint_matches`); otherwise it is built from `data`
+    (the report as read from `source`, read here if not given) and saved.
+    """
+    path = _region_index_path(source)
+    if os.path.exists(path):
+        index, metadata = RegionIndex.open(path)
+        matches, sha256 = fingerprint_matches(source, metadata, sha256)
+        if matches and (data is None or len(data) == index.n_rows):
+            return index
+
+    if data is None:
+        data = read_mobility_csv(source)
+    index = RegionIndex.build(data)
+    index.save(path, **file_fingerprint(source, sha256))
+    return index
+
+
+def read_indexed_mobility_trends(
+    url=MOBILITY_REPORT_URL, offline=None, typed=False, dates="datetime"
+):
+    """
+    Load the mobility report through the local cache (see
+    `read_mobility_trends`) together with its `RegionIndex`, which is built
+    on the first load and saved with the cached file.
+    """
+    path = fetch_cached(url, offline=offline)
+    kwargs = {"dtype": MOBILITY_DTYPES} if typed else {}
+    data = read_mobility_csv(path, dates, **kwargs)
+    # Cached snapshots are named after their SHA-256.
+    sha256 = os.path.splitext(os.path.basename(path))[0]
+    return data, load_region_index(path, data, sha256)
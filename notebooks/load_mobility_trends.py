@@ -0,0 +1,1079 @@
+import csv
+import datetime
+import glob
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import urllib.error
+import urllib.parse
+import urllib.request
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from preprocess_mobility_trends import GEOGRAPHY_COLUMNS, MOBILITY_DTYPES, instrumented
+
+MOBILITY_REPORT_URL = (
+    "https://www.gstatic.com/covid19/mobility/Global_Mobility_Report.csv"
+)
+
+# The cache lives outside the repository so that every notebook (and every
+# re-execution of a notebook) shares the same downloaded copy.
+CACHE_DIR = os.environ.get(
+    "MOBILITY_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "reproducible-data-science"),
+)
+
+# Setting MOBILITY_OFFLINE=1 makes every loader read from the cache only.
+OFFLINE = os.environ.get("MOBILITY_OFFLINE", "0") not in ("", "0")
+
+MAX_SNAPSHOTS = 3
+
+_CHUNK_SIZE = 1 << 20
+
+
+def _source_dir(url, cache_dir):
+    """
+    Return the cache directory used for the file at `url`.
+    """
+    name = os.path.basename(url.split("?")[0]) or "download"
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_dir, "%s-%s" % (key, name))
+
+
+def _read_manifest(source_dir):
+    try:
+        with open(os.path.join(source_dir, "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"snapshots": []}
+
+
+def _write_manifest(source_dir, manifest):
+    # Write to a temporary file first so that a crash never leaves a
+    # half-written manifest behind.
+    fd, tmp_path = tempfile.mkstemp(dir=source_dir, suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(source_dir, "manifest.json"))
+
+
+def _snapshot_path(source_dir, snapshot):
+    extension = os.path.splitext(snapshot["name"])[1]
+    return os.path.join(source_dir, "snapshots", snapshot["sha256"] + extension)
+
+
+def file_sha256(path):
+    """
+    Compute the SHA-256 content hash of the file at `path`.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _download(url, source_dir, headers, timeout):
+    """
+    Stream `url` to a temporary file in `source_dir`, hashing it on the way.
+
+    Returns None when the server answers 304 Not Modified.
+    """
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as error:
+        if error.code == 304:
+            return None
+        raise
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=source_dir, suffix=".part")
+    try:
+        with response, os.fdopen(fd, "wb") as f:
+            for block in iter(lambda: response.read(_CHUNK_SIZE), b""):
+                digest.update(block)
+                f.write(block)
+                size += len(block)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return {
+        "tmp_path": tmp_path,
+        "sha256": digest.hexdigest(),
+        "size": size,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+
+
+def _prune_snapshots(source_dir, manifest, max_snapshots):
+    kept = manifest["snapshots"][:max_snapshots]
+    for snapshot in manifest["snapshots"][max_snapshots:]:
+        path = _snapshot_path(source_dir, snapshot)
+        # Also remove files derived from the snapshot, such as its index. The
+        # snapshot's own file may already be gone (see `_latest_snapshot`).
+        for derived in [path] + glob.glob(path + ".*"):
+            if os.path.exists(derived):
+                os.remove(derived)
+    manifest["snapshots"] = kept
+
+
+def _latest_snapshot(source_dir, manifest, verify):
+    """
+    Return the newest snapshot whose file is present (and intact if `verify`).
+    """
+    for snapshot in manifest["snapshots"]:
+        path = _snapshot_path(source_dir, snapshot)
+        if not os.path.exists(path) or os.path.getsize(path) != snapshot["size"]:
+            continue
+        if verify and file_sha256(path) != snapshot["sha256"]:
+            continue
+        return snapshot
+    return None
+
+
+@instrumented
+def fetch_cached(
+    url,
+    cache_dir=None,
+    offline=None,
+    max_snapshots=MAX_SNAPSHOTS,
+    verify=False,
+    timeout=60,
+):
+    """
+    Return the local path of a cached copy of the file at `url`.
+
+    Downloaded files are stored under their SHA-256 content hash together with
+    the ETag and Last-Modified validators sent by the server. On later calls
+    the server is asked whether the file has changed (a conditional request),
+    so an unchanged file is never downloaded twice. A new download whose
+    content hash matches a stored snapshot is not stored again. At most
+    `max_snapshots` snapshots are kept; older ones are deleted.
+
+    With `offline=True` (or MOBILITY_OFFLINE=1) the network is never touched
+    and the newest cached snapshot is returned. If the network cannot be
+    reached, the newest cached snapshot is returned with a warning.
+
+    Set `verify=True` to recompute the content hash of the cached file before
+    using it and discard the snapshot if it does not match.
+    """
+    cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+    offline = OFFLINE if offline is None else offline
+    source_dir = _source_dir(url, cache_dir)
+    os.makedirs(os.path.join(source_dir, "snapshots"), exist_ok=True)
+
+    manifest = _read_manifest(source_dir)
+    latest = _latest_snapshot(source_dir, manifest, verify)
+
+    if offline:
+        if latest is None:
+            raise FileNotFoundError(
+                "No cached copy of %s in %s and offline mode is on." % (url, cache_dir)
+            )
+        return _snapshot_path(source_dir, latest)
+
+    headers = {}
+    if latest is not None:
+        if latest.get("etag"):
+            headers["If-None-Match"] = latest["etag"]
+        if latest.get("last_modified"):
+            headers["If-Modified-Since"] = latest["last_modified"]
+
+    try:
+        download = _download(url, source_dir, headers, timeout)
+    except (urllib.error.URLError, OSError) as error:
+        if latest is None:
+            raise
+        warnings.warn(
+            "Could not reach %s (%s); using the cached copy from %s."
+            % (url, error, latest["fetched_at"])
+        )
+        return _snapshot_path(source_dir, latest)
+
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    if download is None:
+        latest["checked_at"] = now
+        _write_manifest(source_dir, manifest)
+        return _snapshot_path(source_dir, latest)
+
+    snapshot = {
+        "name": os.path.basename(url.split("?")[0]),
+        "sha256": download["sha256"],
+        "size": download["size"],
+        "etag": download["etag"],
+        "last_modified": download["last_modified"],
+        "fetched_at": now,
+        "checked_at": now,
+    }
+    path = _snapshot_path(source_dir, snapshot)
+    if os.path.exists(path):
+        # Same content under new validators: keep the stored file.
+        os.remove(download["tmp_path"])
+    else:
+        shutil.move(download["tmp_path"], path)
+
+    manifest["url"] = url
+    manifest["snapshots"] = [snapshot] + [
+        s for s in manifest["snapshots"] if s["sha256"] != snapshot["sha256"]
+    ]
+    _prune_snapshots(source_dir, manifest, max_snapshots)
+    _write_manifest(source_dir, manifest)
+    return path
+
+
+# Date parsing
+# ------------
+# The `date` column repeats a few hundred distinct ISO dates over millions of
+# rows. It is read as a categorical, so only the distinct strings are parsed
+# and the result is broadcast back through the category codes.
+
+# Day ordinals are days since 1970-01-01; missing dates get this value.
+DATE_ORDINAL_NA = np.iinfo(np.int32).min
+
+
+def ordinal_date(date):
+    """
+    Return the int32 day ordinal of `date`, for filtering ordinal date columns.
+    """
+    return np.int32((pd.Timestamp(date) - pd.Timestamp(0)).days)
+
+
+def date_ordinals(dates):
+    """
+    Convert the datetime values in `dates` to int32 day ordinals.
+    """
+    days = np.asarray(dates, dtype="datetime64[D]")
+    ordinals = days.view("int64")
+    return np.where(np.isnat(days), DATE_ORDINAL_NA, ordinals).astype(np.int32)
+
+
+def parse_iso_dates(values, ordinal=False):
+    """
+    Parse the ISO dates (`YYYY-MM-DD`) in the Series `values`.
+
+    The distinct strings are parsed once and broadcast back to the rows, which
+    is much faster than parsing every row when dates repeat. Returns a
+    datetime64 Series, or with `ordinal=True` an int32 Series of day ordinals
+    (see `date_ordinals`).
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+    parsed = pd.to_datetime(uniques, format="%Y-%m-%d")
+    if ordinal:
+        parsed = date_ordinals(parsed)
+        missing = np.array([DATE_ORDINAL_NA], dtype=np.int32)
+    else:
+        parsed = parsed.to_numpy()
+        missing = np.array(["NaT"], dtype=parsed.dtype)
+    # Missing values have code -1, which picks the appended missing value.
+    parsed = np.concatenate([parsed, missing])
+    return pd.Series(parsed[codes], index=values.index, name=values.name)
+
+
+def _parse_date_column(data, dates):
+    if "date" in data:
+        data["date"] = parse_iso_dates(data["date"], ordinal=dates == "ordinal")
+    return data
+
+
+def _parse_date_chunks(reader, dates):
+    with reader:
+        for chunk in reader:
+            yield _parse_date_column(chunk, dates)
+
+
+@instrumented
+def read_mobility_csv(source, dates="datetime", **kwargs):
+    """
+    Read a mobility report CSV with `pd.read_csv`, parsing the `date` column
+    with `parse_iso_dates`.
+
+    Pass `dates="ordinal"` for int32 day ordinals instead of datetimes. With
+    `chunksize` an iterator of DataFrames is returned, as with `pd.read_csv`.
+    """
+    dtype = dict(kwargs.pop("dtype", None) or {})
+    usecols = kwargs.get("usecols")
+    if usecols is None or "date" in usecols:
+        dtype["date"] = "category"
+    data = pd.read_csv(source, dtype=dtype, **kwargs)
+    if kwargs.get("chunksize") is not None:
+        return _parse_date_chunks(data, dates)
+    return _parse_date_column(data, dates)
+
+
+@instrumented
+def read_mobility_trends(
+    url=MOBILITY_REPORT_URL, offline=None, typed=False, dates="datetime", **kwargs
+):
+    """
+    Load the Google COVID-19 Community Mobility Report through the local cache.
+
+    This returns the same DataFrame as
+    `pd.read_csv(url, parse_dates=["date"])`, but only the first call downloads
+    the file. With `typed=True` the columns are parsed straight into the
+    memory-lean dtypes of `MOBILITY_DTYPES`, and with `dates="ordinal"` the
+    dates are returned as int32 day ordinals. Extra keyword arguments are
+    passed on to `pd.read_csv`.
+    """
+    path = fetch_cached(url, offline=offline)
+    if typed:
+        kwargs.setdefault("dtype", MOBILITY_DTYPES)
+    return read_mobility_csv(path, dates, **kwargs)
+
+
+# Partitioned columnar store
+# --------------------------
+# The report is converted once into one directory of Parquet files per
+# country (`<store>/country_region=<name>/part-00000.parquet`), so that loading
+# a handful of countries only reads those countries' files.
+
+STORE_DIR = os.path.join(CACHE_DIR, "mobility-store")
+
+PARTITION_COLUMN = "country_region"
+
+_NULL_PARTITION = "__null__"
+
+
+def _partition_dir(value):
+    name = _NULL_PARTITION if pd.isna(value) else urllib.parse.quote(value, safe="")
+    return "%s=%s" % (PARTITION_COLUMN, name)
+
+
+def _common_dtype(a, b):
+    """
+    Return the dtype `pd.read_csv` would give a column seen as `a` and `b`.
+    """
+    if a == b:
+        return a
+    numeric = pd.api.types.is_numeric_dtype
+    if numeric(a) and numeric(b):
+        return np.result_type(a, b)
+    # A text column that is entirely missing in one chunk is read as float.
+    return b if numeric(a) else a
+
+
+def _read_store_manifest(store_dir):
+    with open(os.path.join(store_dir, "manifest.json")) as f:
+        return json.load(f)
+
+
+# Hash of a missing value in any column, and the multiplier that folds the
+# hashes of a row's columns together.
+_NA_HASH = np.uint64(0x9E3779B97F4A7C15)
+_HASH_MULTIPLIER = np.uint64(0x100000001B3)
+
+
+def _column_hashes(values):
+    """
+    Hash the typed values of the Series `values`: numbers as float64, text as
+    strings (categoricals hash the strings of their categories once) and
+    dates as datetime64. Missing values all hash to `_NA_HASH`, so a text
+    column that is entirely missing in one chunk, which `pd.read_csv` reads
+    as float, hashes like the same rows of a text column.
+    """
+    hash_array = pd.util.hash_array
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes = values.cat.codes.to_numpy()
+        categories = values.cat.categories.to_numpy(dtype=object)
+        hashes = np.append(hash_array(categories), _NA_HASH)[codes]
+        return hashes
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        array = values.to_numpy(np.float64, na_value=np.nan)
+    elif pd.api.types.is_datetime64_any_dtype(values.dtype):
+        array = values.to_numpy()
+    else:
+        array = values.to_numpy(dtype=object)
+    hashes = hash_array(array)
+    hashes[values.isna().to_numpy()] = _NA_HASH
+    return hashes
+
+
+def _row_hashes(rows):
+    """
+    Hash each row of `rows`, independently of the dtypes pandas inferred for
+    the chunk the rows were parsed in, without converting values to text.
+    """
+    hashes = np.zeros(len(rows), dtype=np.uint64)
+    for column in rows:
+        hashes = hashes * _HASH_MULTIPLIER + _column_hashes(rows[column])
+    return hashes
+
+
+def _digest(hashes, digest=0):
+    """
+    Add the row `hashes` to `digest`. The sum does not depend on row order,
+    so digests of parts of a partition can be combined.
+    """
+    return (digest + int(hashes.sum(dtype=np.uint64))) % 2**64
+
+
+def _update_schema(schema, chunk):
+    """
+    Fold the column dtypes and categories seen in `chunk` into `schema`.
+    """
+    for column, dtype in chunk.dtypes.items():
+        dtypes = schema["dtypes"]
+        dtypes[column] = _common_dtype(dtypes.get(column, dtype), dtype)
+        if MOBILITY_DTYPES.get(column) == "category":
+            schema["categories"].setdefault(column, set()).update(
+                chunk[column].dropna().unique().tolist()
+            )
+
+
+def _new_partition(store_dir, directory, value):
+    os.makedirs(os.path.join(store_dir, directory), exist_ok=True)
+    return {
+        "value": None if pd.isna(value) else value,
+        "path": directory,
+        "parts": [],
+        "rows": 0,
+        "max_date": None,
+        "digest": 0,
+    }
+
+
+def _new_part(store_dir, directory):
+    """
+    Return a part file name not yet used in the partition `directory`, so
+    that new parts never overwrite parts the manifest still lists.
+    """
+    numbers = [
+        int(name[len("part-") : -len(".parquet")])
+        for name in os.listdir(os.path.join(store_dir, directory))
+        if name.startswith("part-") and name.endswith(".parquet")
+    ]
+    return "part-%05d.parquet" % (max(numbers, default=-1) + 1)
+
+
+def _remove_unreferenced(store_dir, partitions):
+    """
+    Delete the partition directories and part files of `store_dir` that the
+    manifest (with `partitions`) no longer lists, including any left behind
+    by an interrupted update.
+    """
+    prefix = PARTITION_COLUMN + "="
+    for directory in os.listdir(store_dir):
+        path = os.path.join(store_dir, directory)
+        if not directory.startswith(prefix) or not os.path.isdir(path):
+            continue
+        if directory not in partitions:
+            shutil.rmtree(path)
+            continue
+        parts = set(partitions[directory]["parts"])
+        for name in os.listdir(path):
+            if name not in parts:
+                os.remove(os.path.join(path, name))
+
+
+def _write_partitions(chunk, store_dir, partitions):
+    """
+    Append the rows of `chunk` to the per-country partitions of the store.
+    """
+    for value, rows in chunk.groupby(PARTITION_COLUMN, sort=False, dropna=False):
+        rows = rows.drop(columns=PARTITION_COLUMN)
+        directory = _partition_dir(value)
+        if directory not in partitions:
+            partitions[directory] = _new_partition(store_dir, directory, value)
+        partition = partitions[directory]
+        part = _new_part(store_dir, directory)
+        rows.to_parquet(os.path.join(store_dir, directory, part), index=True)
+        partition["parts"].append(part)
+        partition["rows"] += len(rows)
+        partition["digest"] = _digest(_row_hashes(rows), partition["digest"])
+        max_date = rows["date"].max().strftime("%Y-%m-%d")
+        if partition["max_date"] is None or max_date > partition["max_date"]:
+            partition["max_date"] = max_date
+
+
+def _store_manifest(source, schema, partitions, next_row):
+    return {
+        "source_sha256": file_sha256(source),
+        "columns": list(schema["dtypes"]),
+        "dtypes": {column: str(dtype) for column, dtype in schema["dtypes"].items()},
+        "categories": {
+            column: sorted(values) for column, values in schema["categories"].items()
+        },
+        "partitions": list(partitions.values()),
+        "next_row": next_row,
+    }
+
+
+@instrumented
+def build_mobility_store(source=None, store_dir=None, chunksize=1_000_000):
+    """
+    Convert the mobility report CSV at `source` into a store partitioned by
+    `country_region`.
+
+    By default the cached copy of the report is used (see `fetch_cached`).
+    The CSV is converted chunk by chunk, so the whole report is never held in
+    memory. Returns the store directory.
+
+    The store is built in a temporary directory next to `store_dir` and then
+    swapped in. An existing `store_dir` is only replaced if it is empty or
+    holds a store (a `manifest.json`); any other directory raises
+    `FileExistsError` rather than being deleted.
+    """
+    source = fetch_cached(MOBILITY_REPORT_URL) if source is None else source
+    store_dir = STORE_DIR if store_dir is None else store_dir
+    store_dir = os.path.abspath(store_dir)
+    if os.path.exists(store_dir) and os.listdir(store_dir):
+        if not os.path.exists(os.path.join(store_dir, "manifest.json")):
+            raise FileExistsError(
+                "Not replacing %s: it is not a mobility store" % (store_dir,)
+            )
+    parent = os.path.dirname(store_dir)
+    os.makedirs(parent, exist_ok=True)
+    build_dir = tempfile.mkdtemp(dir=parent, prefix=".store-")
+    try:
+        partitions = {}
+        schema = {"dtypes": {}, "categories": {}}
+        next_row = 0
+        for chunk in read_mobility_csv(source, chunksize=chunksize):
+            _update_schema(schema, chunk)
+            _write_partitions(chunk, build_dir, partitions)
+            next_row += len(chunk)
+        manifest = _store_manifest(source, schema, partitions, next_row)
+        _write_manifest(build_dir, manifest)
+    except BaseException:
+        shutil.rmtree(build_dir)
+        raise
+
+    # Swap the new store in, then remove the old one.
+    if os.path.exists(store_dir):
+        old_dir = tempfile.mkdtemp(dir=parent, prefix=".store-")
+        os.replace(store_dir, os.path.join(old_dir, "store"))
+        os.replace(build_dir, store_dir)
+        shutil.rmtree(old_dir)
+    else:
+        os.replace(build_dir, store_dir)
+    return store_dir
+
+
+# Partitions are compacted into a single file once daily updates have
+# appended this many parts.
+MAX_PARTS = 32
+
+
+def _compact_partition(store_dir, partition):
+    # The old parts are left for `_remove_unreferenced` once the manifest no
+    # longer lists them.
+    directory = os.path.join(store_dir, partition["path"])
+    paths = [os.path.join(directory, part) for part in partition["parts"]]
+    rows = pd.concat([pd.read_parquet(path) for path in paths])
+    part = _new_part(store_dir, partition["path"])
+    rows.to_parquet(os.path.join(directory, part), index=True)
+    partition["parts"] = [part]
+
+
+@instrumented
+def update_mobility_store(source=None, store_dir=None, chunksize=1_000_000):
+    """
+    Bring the partitioned store up to date with a newer mobility report at
+    `source`, writing only what changed.
+
+    For each country the rows dated after the newest date already stored are
+    appended as a new part. The stored rows are compared with the report's
+    rows up to that date by an order-independent hash, and only countries
+    whose history was revised are rewritten. Countries new to the report are
+    added and countries no longer in it are removed.
+
+    Appended and rewritten rows get row labels after the largest label in the
+    store, so labels stay unique but only match the row numbers of the CSV
+    for a freshly built store. Returns a summary of the changes.
+
+    New, rewritten and compacted rows are written to new part files, and the
+    manifest is replaced atomically before the files it no longer lists are
+    deleted, so an interrupted update leaves the previous store readable.
+    """
+    source = fetch_cached(MOBILITY_REPORT_URL) if source is None else source
+    store_dir = STORE_DIR if store_dir is None else store_dir
+    manifest = _read_store_manifest(store_dir)
+    schema = {
+        "dtypes": {
+            column: pd.api.types.pandas_dtype(dtype)
+            for column, dtype in manifest["dtypes"].items()
+        },
+        "categories": {
+            column: set(values) for column, values in manifest["categories"].items()
+        },
+    }
+    partitions = {p["path"]: p for p in manifest["partitions"]}
+    history = {directory: [0, 0] for directory in partitions}
+    appended = {}
+
+    # First pass: hash the history of every stored country and keep the
+    # rows dated after its newest stored date.
+    for chunk in read_mobility_csv(source, chunksize=chunksize):
+        _update_schema(schema, chunk)
+        for value, rows in chunk.groupby(PARTITION_COLUMN, sort=False, dropna=False):
+            directory = _partition_dir(value)
+            if directory in partitions:
+                max_date = pd.Timestamp(partitions[directory]["max_date"])
+                is_new = (rows["date"] > max_date).to_numpy()
+                old_rows = rows[~is_new].drop(columns=PARTITION_COLUMN)
+                history[directory][0] = _digest(
+                    _row_hashes(old_rows), history[directory][0]
+                )
+                history[directory][1] += len(old_rows)
+                rows = rows[is_new]
+            if len(rows):
+                appended.setdefault(directory, []).append(rows)
+
+    revised = [
+        directory
+        for directory, partition in partitions.items()
+        if history[directory] != [partition["digest"], partition["rows"]]
+    ]
+    revised = {directory: partitions[directory]["value"] for directory in revised}
+    next_row = manifest["next_row"]
+    for directory in revised:
+        # The rewritten rows go to new parts; the old ones stay listed in the
+        # current manifest until the new one replaces it.
+        appended.pop(directory, None)
+        value = partitions[directory]["value"]
+        partitions[directory] = _new_partition(store_dir, directory, value)
+
+    # Second pass, only if needed: rewrite the countries with revised history.
+    if revised:
+        values = list(revised.values())
+        for chunk in read_mobility_csv(source, chunksize=chunksize):
+            rows = chunk[chunk[PARTITION_COLUMN].isin(values)]
+            rows.index = pd.RangeIndex(next_row, next_row + len(rows))
+            next_row += len(rows)
+            _write_partitions(rows, store_dir, partitions)
+        for directory in revised:
+            if not partitions[directory]["parts"]:
+                del partitions[directory]
+
+    rows = pd.concat(
+        [frame for frames in appended.values() for frame in frames]
+        or [pd.DataFrame(columns=list(schema["dtypes"]))]
+    )
+    rows.index = pd.RangeIndex(next_row, next_row + len(rows))
+    next_row += len(rows)
+    added = [directory for directory in appended if directory not in partitions]
+    _write_partitions(rows, store_dir, partitions)
+    for partition in partitions.values():
+        if len(partition["parts"]) > MAX_PARTS:
+            _compact_partition(store_dir, partition)
+
+    # Swap the new manifest in, then delete the files only the old one listed.
+    _write_manifest(store_dir, _store_manifest(source, schema, partitions, next_row))
+    _remove_unreferenced(store_dir, partitions)
+    return {
+        "appended_rows": len(rows),
+        "added": [partitions[directory]["value"] for directory in added],
+        "rewritten": [
+            value for directory, value in revised.items() if directory in partitions
+        ],
+        "removed": [
+            value for directory, value in revised.items() if directory not in partitions
+        ],
+    }
+
+
+def _store_dtypes(manifest, typed):
+    """
+    Return the dtype of each stored column, as read from the CSV or, if
+    `typed`, as given by `MOBILITY_DTYPES`.
+    """
+    dtypes = dict(manifest["dtypes"])
+    if typed:
+        for column, dtype in MOBILITY_DTYPES.items():
+            if column not in dtypes:
+                continue
+            if dtype == "category":
+                # Fixing the categories up front lets the partitions be
+                # concatenated without falling back to object columns.
+                dtype = pd.CategoricalDtype(manifest["categories"][column])
+            dtypes[column] = dtype
+    return dtypes
+
+
+@instrumented
+def load_mobility(countries=None, columns=None, store_dir=None, typed=False):
+    """
+    Load the mobility data from the partitioned store.
+
+    Only the partitions of the countries in `countries` (a name or a list of
+    names; all countries by default) are read, and only the columns in
+    `columns` (all by default). The result is the same DataFrame, index
+    included, as loading the full report with
+    `pd.read_csv(..., parse_dates=["date"])` and then filtering with
+    `data[data["country_region"].isin(countries)][columns]`, except that names
+    in `columns` that are not columns of the report are ignored.
+
+    With `typed=True` the columns are returned in the memory-lean dtypes of
+    `MOBILITY_DTYPES`, converted partition by partition.
+
+    The store is built from the cached report on first use.
+    """
+    store_dir = STORE_DIR if store_dir is None else store_dir
+    if not os.path.exists(os.path.join(store_dir, "manifest.json")):
+        build_mobility_store(store_dir=store_dir)
+    manifest = _read_store_manifest(store_dir)
+
+    if columns is None:
+        columns = manifest["columns"]
+    else:
+        # The caller's order; names the store lacks are dropped.
+        columns = [column for column in columns if column in manifest["columns"]]
+    dtypes = _store_dtypes(manifest, typed)
+    dtypes = {column: dtypes[column] for column in columns}
+    read_columns = [column for column in columns if column != PARTITION_COLUMN]
+
+    partitions = manifest["partitions"]
+    if countries is not None:
+        if isinstance(countries, str):
+            countries = [countries]
+        partitions = [p for p in partitions if p["value"] in set(countries)]
+
+    frames = []
+    for partition in partitions:
+        for part in partition["parts"]:
+            frame = pd.read_parquet(
+                os.path.join(store_dir, partition["path"], part),
+                columns=read_columns,
+            )
+            if PARTITION_COLUMN in columns:
+                frame[PARTITION_COLUMN] = partition["value"]
+            frames.append(frame[columns].astype(dtypes))
+    if not frames:
+        return pd.DataFrame(
+            {column: pd.Series(dtype=dtype) for column, dtype in dtypes.items()}
+        )
+
+    data = pd.concat(frames)
+    if data.index.equals(pd.RangeIndex(len(data))):
+        data.index = pd.RangeIndex(len(data))
+    return data
+
+
+# Streaming reader
+# ----------------
+# Filters are applied to each chunk as it is parsed, so peak memory is set by
+# the chunk size and the matching rows rather than by the full report.
+
+
+def iter_mobility_trends(
+    source=None,
+    start_date=None,
+    end_date=None,
+    countries=None,
+    columns=None,
+    chunksize=250_000,
+    typed=False,
+    dates="datetime",
+):
+    """
+    Read the mobility report at `source` chunk by chunk, yielding only the
+    matching rows of each chunk.
+
+    Rows are kept if their date lies between `start_date` and `end_date`
+    (both included, either may be None) and their `country_region` is in
+    `countries` (a name or a list of names). Only the columns in `columns`
+    are parsed; by default all columns are returned. With `typed=True` the
+    columns are parsed into the dtypes of `MOBILITY_DTYPES`, and with
+    `dates="ordinal"` the dates into int32 day ordinals.
+
+    By default the cached copy of the report is read (see `fetch_cached`).
+    """
+    source = fetch_cached(MOBILITY_REPORT_URL) if source is None else source
+    if isinstance(countries, str):
+        countries = [countries]
+
+    usecols = None
+    if columns is not None:
+        usecols = set(columns)
+        if start_date is not None or end_date is not None:
+            usecols.add("date")
+        if countries is not None:
+            usecols.add("country_region")
+
+    kwargs = {}
+    if typed:
+        kwargs["dtype"] = MOBILITY_DTYPES
+    convert = ordinal_date if dates == "ordinal" else pd.Timestamp
+    chunks = read_mobility_csv(
+        source, dates, usecols=usecols, chunksize=chunksize, **kwargs
+    )
+    for chunk in chunks:
+        mask = np.ones(len(chunk), dtype=bool)
+        if start_date is not None:
+            mask &= (chunk["date"] >= convert(start_date)).to_numpy()
+        if end_date is not None:
+            mask &= (chunk["date"] <= convert(end_date)).to_numpy()
+        if countries is not None:
+            mask &= chunk["country_region"].isin(countries).to_numpy()
+        if not mask.any():
+            continue
+        chunk = chunk[mask]
+        if columns is not None:
+            chunk = chunk[[column for column in chunk if column in columns]]
+        yield chunk
+
+
+def concat_mobility_chunks(chunks):
+    """
+    Concatenate the chunks yielded by `iter_mobility_trends` into one DataFrame.
+
+    Categorical columns are merged with `union_categoricals`, so that they do
+    not fall back to object columns when the chunks saw different categories.
+    """
+    chunks = list(chunks)
+    if not chunks:
+        return pd.DataFrame()
+    data = pd.concat(chunks)
+    for column, dtype in chunks[0].dtypes.items():
+        if not isinstance(dtype, pd.CategoricalDtype):
+            continue
+        if not isinstance(data[column].dtype, pd.CategoricalDtype):
+            merged = pd.api.types.union_categoricals(
+                [chunk[column] for chunk in chunks], sort_categories=True
+            )
+            data[column] = pd.Series(merged, index=data.index)
+    return data
+
+
+@instrumented
+def read_mobility_window(
+    source=None,
+    start_date=None,
+    end_date=None,
+    countries=None,
+    columns=None,
+    chunksize=250_000,
+    typed=False,
+    dates="datetime",
+):
+    """
+    Read only the matching rows of the mobility report at `source`.
+
+    This returns the same rows as loading the full report and then calling
+    `subperiod_mobility_trends(data, start_date, end_date)` and filtering by
+    country, without ever holding the full report in memory. See
+    `iter_mobility_trends` for the arguments.
+    """
+    return concat_mobility_chunks(
+        iter_mobility_trends(
+            source, start_date, end_date, countries, columns, chunksize, typed, dates
+        )
+    )
+
+
+# Byte-offset index
+# -----------------
+# The report is laid out in contiguous blocks of rows per country and region.
+# The index records the byte range (and first row number) of every block, so
+# that a few countries can be read by seeking straight to their bytes.
+
+# Geographic columns holding text in the full report (`census_fips_code` is
+# numeric).
+TEXT_COLUMNS = [column for column in GEOGRAPHY_COLUMNS if column != "census_fips_code"]
+
+_QUOTE = b'"'
+
+
+def file_fingerprint(source, sha256=None):
+    """
+    Return the SHA-256 content hash (hashed here unless given as `sha256`),
+    size and modification time of the file at `source`, to be saved with
+    files derived from it (see `fingerprint_matches`).
+    """
+    stat = os.stat(source)
+    return {
+        "sha256": file_sha256(source) if sha256 is None else sha256,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def fingerprint_matches(source, fingerprint, sha256=None):
+    """
+    Tell whether the file at `source` still has the content recorded in
+    `fingerprint` (see `file_fingerprint`), judged by `sha256` when given.
+    Otherwise the file is re-hashed unless its size and modification time
+    are unchanged. Returns whether it matches and the file's hash, which
+    can be passed on to `file_fingerprint` when rebuilding.
+    """
+    if sha256 is None:
+        stat = os.stat(source)
+        unchanged = (fingerprint["size"], fingerprint["mtime_ns"]) == (
+            stat.st_size,
+            stat.st_mtime_ns,
+        )
+        sha256 = fingerprint["sha256"] if unchanged else file_sha256(source)
+    return sha256 == fingerprint["sha256"], sha256
+
+
+def _offset_index_path(source):
+    return source + ".index.json"
+
+
+def _key_fields(line):
+    """
+    Return the raw prefix of `line` up to `sub_region_1` and the
+    `country_region` and `sub_region_1` values.
+    """
+    if _QUOTE in line:
+        # Quoted names may contain commas, so use the csv module for these
+        # rare lines (and do not reuse their prefix).
+        fields = next(csv.reader([line.decode("utf-8")]))
+        return None, fields[1], fields[2]
+    code, country, sub_region, _ = line.split(b",", 3)
+    prefix = line[: len(code) + len(country) + len(sub_region) + 3]
+    return prefix, country.decode("utf-8"), sub_region.decode("utf-8")
+
+
+def _add_range(ranges, block):
+    # Merge with the previous range when the blocks are adjacent.
+    if ranges and ranges[-1][1] == block[0]:
+        ranges[-1][1] = block[1]
+        ranges[-1][3] += block[3]
+    else:
+        ranges.append(list(block))
+
+
+@instrumented
+def build_offset_index(source, sha256=None):
+    """
+    Index the byte ranges of each country and `sub_region_1` in the mobility
+    report CSV at `source`.
+
+    Every entry is a list of `[start_byte, end_byte, first_row, n_rows]`
+    ranges. The index is saved next to `source` together with the file's
+    SHA-256 content hash, and returned.
+    """
+    countries = {}
+    sub_regions = {}
+
+    def close_block(key, block):
+        country, sub_region = key
+        _add_range(countries.setdefault(country, []), block)
+        _add_range(
+            sub_regions.setdefault(country, {}).setdefault(sub_region, []), block
+        )
+
+    with open(source, "rb") as f:
+        header = f.readline()
+        offset = len(header)
+        row = 0
+        prefix = None
+        key = None
+        block = None
+        for line in f:
+            if prefix is None or not line.startswith(prefix):
+                prefix, country, sub_region = _key_fields(line)
+                if (country, sub_region) != key:
+                    if block is not None:
+                        close_block(key, block)
+                    key = (country, sub_region)
+                    block = [offset, offset, row, 0]
+            offset += len(line)
+            row += 1
+            block[1] = offset
+            block[3] += 1
+        if block is not None:
+            close_block(key, block)
+
+    index = dict(
+        file_fingerprint(source, sha256),
+        header_size=len(header),
+        countries=countries,
+        sub_regions=sub_regions,
+    )
+    with open(_offset_index_path(source), "w") as f:
+        json.dump(index, f)
+    return index
+
+
+def load_offset_index(source, sha256=None):
+    """
+    Return the byte-offset index of the mobility report CSV at `source`.
+
+    The saved index is reused if it was built for the same content (see
+    `fingerprint_matches`); a stale or missing index is rebuilt.
+    """
+    try:
+        with open(_offset_index_path(source)) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return build_offset_index(source, sha256)
+
+    matches, sha256 = fingerprint_matches(source, index, sha256)
+    if not matches:
+        return build_offset_index(source, sha256)
+    return index
+
+
+@instrumented
+def read_mobility_countries(
+    countries,
+    sub_regions=None,
+    source=None,
+    columns=None,
+    typed=False,
+    dates="datetime",
+):
+    """
+    Read the rows of the countries in `countries` (a name or a list of names)
+    by seeking to their byte ranges in the mobility report at `source`.
+
+    Pass a list of `sub_region_1` names as `sub_regions` to narrow the
+    selection further. The result equals filtering the full report (index
+    included) but only the selected bytes are parsed; the text columns of
+    `TEXT_COLUMNS` are read as text even where the selection has no value in
+    them. See
+    `iter_mobility_trends` for `typed` and `dates`. By default the cached
+    copy of the report is read (see `fetch_cached`).
+    """
+    sha256 = None
+    if source is None:
+        source = fetch_cached(MOBILITY_REPORT_URL)
+        # Cached snapshots are named after their content hash.
+        sha256 = os.path.splitext(os.path.basename(source))[0]
+    index = load_offset_index(source, sha256)
+    if isinstance(countries, str):
+        countries = [countries]
+    if isinstance(sub_regions, str):
+        sub_regions = [sub_regions]
+
+    ranges = []
+    for country in countries:
+        if sub_regions is None:
+            ranges.extend(index["countries"].get(country, []))
+        else:
+            country_sub_regions = index["sub_regions"].get(country, {})
+            for sub_region in sub_regions:
+                ranges.extend(country_sub_regions.get(sub_region, []))
+    ranges.sort()
+
+    buffer = io.BytesIO()
+    with open(source, "rb") as f:
+        buffer.write(f.read(index["header_size"]))
+        for start, end, _, _ in ranges:
+            f.seek(start)
+            buffer.write(f.read(end - start))
+    buffer.seek(0)
+
+    # A text column can be empty throughout the selected rows (e.g.
+    # `metro_area` for most countries), which `pd.read_csv` would read as
+    # float; the full report has values in each, so it reads them as text.
+    dtype = MOBILITY_DTYPES if typed else dict.fromkeys(TEXT_COLUMNS, str)
+    data = read_mobility_csv(buffer, dates, usecols=columns, dtype=dtype)
+    data.index = np.concatenate(
+        [np.arange(first, first + n) for _, _, first, n in ranges] or [np.arange(0)]
+    )
+    return data
@@ -0,0 +1,162 @@
+import concurrent.futures
+import functools
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Shards are written to shared memory when the system has it (/dev/shm on
+# Linux) and it has room for them, so that workers map them without touching
+# the disk.
+SHARED_MEMORY_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def _shard_dir(data):
+    """
+    Return the directory to write the shards of `data` to: shared memory if
+    it has room for them, else the default temporary directory (None).
+    Overrunning a memory-mapped file on a full tmpfs (Docker gives /dev/shm
+    64 MB by default) kills the process with SIGBUS instead of raising.
+    """
+    if SHARED_MEMORY_DIR is None:
+        return None
+    # Codes of text columns take no more than the pointers counted here.
+    needed = int(data.memory_usage(index=True, deep=False).sum())
+    free = shutil.disk_usage(SHARED_MEMORY_DIR).free
+    return SHARED_MEMORY_DIR if needed * 1.25 < free else None
+
+
+def _encode_column(values):
+    """
+    Split a column into an array that can be memory-mapped and the (small)
+    metadata needed to rebuild it.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy(), ("categorical", values.dtype)
+    array = values.to_numpy()
+    if array.dtype.kind in "biufcmM":
+        return array, ("array", values.dtype)
+    # Text and other objects are stored as codes into their distinct values.
+    codes, uniques = pd.factorize(values)
+    return codes, ("factorized", (values.dtype, np.asarray(uniques, dtype=object)))
+
+
+def _decode_column(array, metadata):
+    kind, detail = metadata
+    if kind == "categorical":
+        return pd.Categorical.from_codes(array, dtype=detail)
+    if kind == "array":
+        return pd.array(np.asarray(array), dtype=detail)
+    dtype, uniques = detail
+    values = uniques.take(array)
+    values[array < 0] = np.nan
+    return pd.array(values, dtype=dtype)
+
+
+def _share_frame(data, order, directory):
+    """
+    Write the rows of `data` in `order` to `directory`, one memory-mapped
+    `.npy` file per column.
+    """
+    frame = data.reset_index()
+    columns = []
+    for number, column in enumerate(frame.columns):
+        array, metadata = _encode_column(frame[column])
+        path = os.path.join(directory, "%d.npy" % number)
+        shared = np.lib.format.open_memmap(
+            path, mode="w+", dtype=array.dtype, shape=order.shape
+        )
+        np.take(array, order, out=shared)
+        shared.flush()
+        columns.append((column, metadata))
+    layout = {"columns": columns, "index": list(data.index.names)}
+    with open(os.path.join(directory, "layout.pickle"), "wb") as f:
+        pickle.dump(layout, f)
+
+
+@functools.lru_cache(maxsize=4)
+def _open_frame(directory):
+    with open(os.path.join(directory, "layout.pickle"), "rb") as f:
+        layout = pickle.load(f)
+    arrays = [
+        np.load(os.path.join(directory, "%d.npy" % number), mmap_mode="r")
+        for number in range(len(layout["columns"]))
+    ]
+    return layout, arrays
+
+
+def _read_shard(directory, start, stop):
+    """
+    Rebuild the rows `start:stop` of the DataFrame shared in `directory`.
+    """
+    layout, arrays = _open_frame(directory)
+    shard = pd.DataFrame(
+        {
+            column: _decode_column(array[start:stop], metadata)
+            for (column, metadata), array in zip(layout["columns"], arrays)
+        }
+    )
+    index = [column for column, _ in layout["columns"][: len(layout["index"])]]
+    shard = shard.set_index(index if len(index) > 1 else index[0])
+    shard.index.names = layout["index"]
+    return shard
+
+
+def _map_shard(func, directory, start, stop):
+    return func(_read_shard(directory, start, stop))
+
+
+def map_by_region(data, func, level="country_region", workers=None):
+    """
+    Apply `func` to the rows of each region of `data` in a pool of worker
+    processes, like `data.groupby(level).apply(func)`.
+
+    `level` is the column (or list of columns) the regions are told apart by,
+    and `workers` the number of processes (by default one per core; with
+    `workers=1` everything runs in this process). The rows are written once,
+    grouped by region, to memory-mapped files in shared memory; each worker
+    maps them and reads only its region's rows, so no shard is pickled.
+    `func` must be picklable, i.e. defined at module level, not a lambda.
+
+    The results are returned in region order and combined as
+    `groupby().apply` does: Series with the same index (e.g. the mean of each
+    category) become the rows of a DataFrame indexed by region, other
+    DataFrames and Series are concatenated with the region as the outer index
+    level, and scalars form a Series indexed by region.
+    """
+    groups = data.groupby(level, sort=True, observed=True)
+    # Rows without a region (NaN) have no group number.
+    codes = groups.ngroup().fillna(-1).to_numpy(np.intp)
+    # The regions, indexed as `groupby` indexes its results.
+    index = groups.size().index
+    keep = np.flatnonzero(codes >= 0)
+    order = keep[np.argsort(codes[keep], kind="stable")]
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(codes[keep]))])
+
+    with tempfile.TemporaryDirectory(dir=_shard_dir(data)) as directory:
+        _share_frame(data, order, directory)
+        shards = [(directory, int(a), int(b)) for a, b in zip(bounds, bounds[1:])]
+        if workers == 1:
+            results = [_map_shard(func, *shard) for shard in shards]
+        else:
+            # Largest regions first, so that no worker ends with a long one.
+            with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+                futures = {
+                    code: executor.submit(_map_shard, func, *shards[code])
+                    for code in np.argsort(np.diff(bounds))[::-1]
+                }
+                results = [futures[code].result() for code in range(len(shards))]
+        _open_frame.cache_clear()
+
+    if results and all(isinstance(r, pd.Series) for r in results):
+        if all(r.index.equals(results[0].index) for r in results[1:]):
+            frame = pd.concat(results, axis=1, ignore_index=True).T
+            frame.index = index
+            frame.columns = results[0].index
+            return frame
+    if results and all(isinstance(r, (pd.DataFrame, pd.Series)) for r in results):
+        return pd.concat(results, keys=index)
+    return pd.Series(results, index=index)
@@ -1,29 +1,783 @@
+import collections
+import contextlib
+import copy
+import datetime
+import functools
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+import tracemalloc
+import weakref
 
+import numpy as np
+import pandas as pd
 
+# Columns identifying the place each row of the mobility data refers to.
+GEOGRAPHY_COLUMNS = [
+    "country_region_code",
+    "country_region",
+    "sub_region_1",
+    "sub_region_2",
+    "metro_area",
+    "iso_3166_2_code",
+    "census_fips_code",
+    "place_id",
+]
+
+# The six mobility categories, in the order they appear in the data.
+CATEGORY_COLUMNS = [
+    "retail_and_recreation_percent_change_from_baseline",
+    "grocery_and_pharmacy_percent_change_from_baseline",
+    "parks_percent_change_from_baseline",
+    "transit_stations_percent_change_from_baseline",
+    "workplaces_percent_change_from_baseline",
+    "residential_percent_change_from_baseline",
+]
+
+# Memory-lean dtypes for the mobility data. The geographic columns hold a few
+# thousand distinct names repeated over millions of rows, so they are stored
+# as categoricals (and `==`/`isin` filters compare integer codes). The percent
+# changes are whole numbers, which float32 stores exactly while keeping NaN
+# for missing values.
+MOBILITY_DTYPES = dict(
+    [(column, "category") for column in GEOGRAPHY_COLUMNS]
+    + [(column, "float32") for column in CATEGORY_COLUMNS]
+)
+
+# Short names of the six mobility categories used from chapter 05 onwards.
+CATEGORY_NAMES = [
+    "Retail_Recreation",
+    "Grocery_Pharmacy",
+    "Parks",
+    "Transit_stations",
+    "Workplaces",
+    "Residential",
+]
+
+
+# Instrumentation of preprocessing steps
+# --------------------------------------
+# Opt-in timing and memory accounting of the preprocessing functions and of
+# the loaders, to find which step of a slow cell is to blame. Enable it with
+# `instrument()` or by setting the environment variable
+# `MOBILITY_INSTRUMENT_LOG` to the path of a JSON log file.
+#
+# Calls are tracked per thread (each thread has its own stack of open calls),
+# but the tracemalloc peak is shared by the whole process: a call that
+# overlaps one in another thread, as in `load_course_datasets`, is marked
+# `overlapped` and gets no `peak_bytes`.
+
+# `owns_tracing` is whether `start_instrumentation` started tracemalloc, and
+# so whether `stop_instrumentation` should stop it.
+_INSTRUMENTATION = {
+    "records": None,
+    "log_path": None,
+    "active": 0,
+    "started": 0,
+    "owns_tracing": False,
+}
+_INSTRUMENTATION_LOCK = threading.Lock()
+_THREAD_CALLS = threading.local()
+
+
+def _frame_size(value):
+    # Shallow memory usage: text columns count their pointers only.
+    if isinstance(value, pd.DataFrame):
+        return len(value), int(value.memory_usage(deep=False).sum())
+    if isinstance(value, pd.Series):
+        return len(value), int(value.memory_usage(deep=False))
+    return None, None
+
+
+def _first_frame(args, kwargs):
+    for value in list(args) + list(kwargs.values()):
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            return value
+    return None
+
+
+def instrumented(func):
+    """
+    Decorator recording, while instrumentation is on, the wall time, CPU time,
+    tracemalloc peak and rows and bytes in and out of each call to `func`.
+    The peak of a call that overlaps calls in other threads is not known and
+    recorded as None.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _INSTRUMENTATION["records"] is None:
+            return func(*args, **kwargs)
+
+        if not hasattr(_THREAD_CALLS, "stack"):
+            _THREAD_CALLS.stack, _THREAD_CALLS.started = [], 0
+        stack = _THREAD_CALLS.stack
+        with _INSTRUMENTATION_LOCK:
+            # Calls of other threads open now, or started before this ends.
+            overlapped = _INSTRUMENTATION["active"] > len(stack)
+            _INSTRUMENTATION["active"] += 1
+            _INSTRUMENTATION["started"] += 1
+            _THREAD_CALLS.started += 1
+            others_start = _INSTRUMENTATION["started"] - _THREAD_CALLS.started
+        memory_start = tracemalloc.get_traced_memory()[0]
+        if hasattr(tracemalloc, "reset_peak"):
+            # Without `reset_peak` (Python < 3.9) peaks are since tracing began.
+            tracemalloc.reset_peak()
+        stack.append(0)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.process_time() - cpu_start
+            # Nested calls reset the peak, so theirs is carried up the stack.
+            peak = max(tracemalloc.get_traced_memory()[1], stack.pop())
+            if stack:
+                stack[-1] = max(stack[-1], peak)
+            with _INSTRUMENTATION_LOCK:
+                _INSTRUMENTATION["active"] -= 1
+                others = _INSTRUMENTATION["started"] - _THREAD_CALLS.started
+                overlapped = overlapped or others != others_start
+        rows_in, bytes_in = _frame_size(_first_frame(args, kwargs))
+        rows_out, bytes_out = _frame_size(result)
+        _record(
+            {
+                "function": func.__name__,
+                "module": func.__module__,
+                "started": time.time() - wall_time,
+                "depth": len(stack),
+                "wall_time": wall_time,
+                "cpu_time": cpu_time,
+                "peak_bytes": None if overlapped else max(peak - memory_start, 0),
+                "overlapped": overlapped,
+                "thread": threading.current_thread().name,
+                "rows_in": rows_in,
+                "bytes_in": bytes_in,
+                "rows_out": rows_out,
+                "bytes_out": bytes_out,
+            }
+        )
+        return result
+
+    return wrapper
+
+
+def _record(record):
+    with _INSTRUMENTATION_LOCK:
+        _INSTRUMENTATION["records"].append(record)
+        if _INSTRUMENTATION["log_path"] is not None:
+            with open(_INSTRUMENTATION["log_path"], "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+def start_instrumentation(log_path=None):
+    """
+    Start recording the calls of instrumented functions, appending each
+    record as a line of JSON to `log_path` if given. Returns the list the
+    records are collected in.
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _INSTRUMENTATION["owns_tracing"] = True
+    _INSTRUMENTATION.update(records=[], log_path=log_path)
+    return _INSTRUMENTATION["records"]
+
+
+def stop_instrumentation():
+    """
+    Stop recording, and return the records collected since the start.
+    Tracing by tracemalloc is left on if it was on before the start.
+    """
+    records = _INSTRUMENTATION["records"]
+    _INSTRUMENTATION.update(records=None, log_path=None)
+    if _INSTRUMENTATION["owns_tracing"]:
+        _INSTRUMENTATION["owns_tracing"] = False
+        tracemalloc.stop()
+    return records
+
+
+@contextlib.contextmanager
+def instrument(log_path=None):
+    """
+    Record the calls of instrumented functions within a `with` block:
+
+        with instrument("pipeline.jsonl") as records:
+            mobility_trends = read_mobility_trends()
+            ...
+        print(instrumentation_summary(records))
+    """
+    records = start_instrumentation(log_path)
+    try:
+        yield records
+    finally:
+        stop_instrumentation()
+
+
+def read_instrumentation_log(log_path):
+    """
+    Read the records of a JSON log written by `instrument`.
+    """
+    with open(log_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def instrumentation_summary(records):
+    """
+    Summarise instrumentation records (a list, or the path of a JSON log) as
+    one row per function, slowest first.
+    """
+    if isinstance(records, str):
+        records = read_instrumentation_log(records)
+    columns = ["wall_time", "cpu_time", "peak_bytes", "rows_in", "rows_out"]
+    records = pd.DataFrame(records, columns=["function"] + columns)
+    summary = records.groupby("function").agg(
+        calls=("wall_time", "size"),
+        wall_time=("wall_time", "sum"),
+        max_wall_time=("wall_time", "max"),
+        cpu_time=("cpu_time", "sum"),
+        peak_bytes=("peak_bytes", "max"),
+        rows_in=("rows_in", "sum"),
+        rows_out=("rows_out", "sum"),
+    )
+    return summary.sort_values("wall_time", ascending=False)
+
+
+if os.environ.get("MOBILITY_INSTRUMENT_LOG"):
+    start_instrumentation(os.environ["MOBILITY_INSTRUMENT_LOG"])
+
+
+class MobilitySchema:
+    """
+    Names, dtypes and order of the columns of the mobility data.
+
+    The six mobility categories are looked up by name, under either their raw
+    (`parks_percent_change_from_baseline`) or short (`Parks`) name, instead of
+    by position, so the code keeps working if columns are added or moved.
+    """
+
+    def __init__(
+        self,
+        geography_columns=GEOGRAPHY_COLUMNS,
+        category_columns=CATEGORY_COLUMNS,
+        category_names=CATEGORY_NAMES,
+        dtypes=MOBILITY_DTYPES,
+    ):
+        self.geography_columns = list(geography_columns)
+        self.category_columns = list(category_columns)
+        self.category_names = list(category_names)
+        self.dtypes = dict(dtypes)
+        self.short_names = dict(zip(self.category_columns, self.category_names))
+        self.raw_names = dict(zip(self.category_names, self.category_columns))
+
+    def category_labels(self, data):
+        """
+        Return the column labels of the six categories in `data`, whether they
+        have their raw or short names, in category order.
+        """
+        labels = []
+        for raw, short in self.short_names.items():
+            if raw in data:
+                labels.append(raw)
+            elif short in data:
+                labels.append(short)
+        return labels
+
+    def category(self, data, name):
+        """
+        Return the column of the category `name` (raw or short) of `data`.
+        """
+        if name in data:
+            return data[name]
+        other = self.short_names.get(name, self.raw_names.get(name))
+        if other is None or other not in data:
+            raise KeyError(name)
+        return data[other]
+
+    def categories(self, data):
+        """
+        Return the six category columns of `data`.
+        """
+        return data[self.category_labels(data)]
+
+    def rename(self, data, copy=True):
+        """
+        Give the six categories of `data` their short names.
+
+        With `copy=False` the result shares its data with `data`: only the
+        column labels are new, so renaming costs nothing whatever the size of
+        `data`.
+        """
+        if copy:
+            return data.rename(columns=self.short_names)
+        renamed = data.copy(deep=False)
+        renamed.columns = [self.short_names.get(c, c) for c in data.columns]
+        return renamed
+
+    def apply(self, data):
+        """
+        Convert the columns of `data` to the memory-lean dtypes of the schema.
+        """
+        dtypes = {}
+        for column, dtype in self.dtypes.items():
+            if column in data:
+                dtypes[column] = dtype
+            elif self.short_names.get(column) in data:
+                dtypes[self.short_names[column]] = dtype
+        return data.astype(dtypes)
+
+
+MOBILITY_SCHEMA = MobilitySchema()
+
+
+@instrumented
+def apply_mobility_schema(data):
+    """
+    Convert the mobility data in `data` to the memory-lean dtypes in `MOBILITY_DTYPES`.
+
+    Note that grouping by a categorical column lists every category, including
+    those absent from `data`, unless `observed=True` is passed to `groupby`.
+    """
+    return MOBILITY_SCHEMA.apply(data)
+
+
+# Memoization of preprocessing steps
+# ----------------------------------
+# The same preprocessing steps are rerun on the same data in several chapters
+# and in every re-execution of a notebook. `memoize` caches the results of a
+# function in memory, least recently used first out once a byte budget is
+# exceeded, and optionally on disk so that other processes can reuse them.
+# It is opt-in: hashing the arguments costs more than cheap steps such as
+# `subperiod_mobility_trends` save, so it only pays off for expensive ones.
+
+MEMO_MAX_BYTES = 512 * 2**20
+
+MemoInfo = collections.namedtuple(
+    "MemoInfo", ["hits", "disk_hits", "misses", "entries", "bytes"]
+)
+
+
+def frame_fingerprint(data):
+    """
+    Return a fingerprint of the DataFrame (or Series) `data`: a hash of its
+    shape, columns, dtypes and of every row, index included, so that data
+    changed in place gets a new fingerprint. It reads all of `data`.
+    """
+    digest = hashlib.sha256()
+    columns = list(data.columns) if isinstance(data, pd.DataFrame) else data.name
+    dtypes = data.dtypes if isinstance(data, pd.DataFrame) else [data.dtype]
+    layout = (data.shape, columns, [str(t) for t in dtypes])
+    digest.update(repr(layout).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(data).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+# Argument types whose `repr` is exact, i.e. different values never share it.
+_EXACT_REPR_TYPES = (
+    type(None),
+    bool,
+    int,
+    float,
+    complex,
+    str,
+    bytes,
+    np.generic,
+    datetime.date,
+    datetime.timedelta,
+    pd.Timestamp,
+    pd.Timedelta,
+)
+
+
+def _describe_argument(value):
+    """
+    Return a string identifying the argument `value` by content, for
+    `_memo_key`. Raises TypeError for values that cannot be identified.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return frame_fingerprint(value)
+    if isinstance(value, pd.Index):
+        hashes = pd.util.hash_pandas_object(value).to_numpy()
+        digest = hashlib.sha256(hashes.tobytes()).hexdigest()
+        return "Index(%s, %r, %s)" % (value.dtype, value.name, digest)
+    if isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            data = pd.util.hash_array(value.ravel()).tobytes()
+        else:
+            data = np.ascontiguousarray(value).tobytes()
+        digest = hashlib.sha256(data).hexdigest()
+        return "ndarray(%s, %s, %s)" % (value.dtype, value.shape, digest)
+    if isinstance(value, (tuple, list, set, frozenset)):
+        items = [_describe_argument(item) for item in value]
+        if isinstance(value, (set, frozenset)):
+            items.sort()
+        return "%s(%s)" % (type(value).__name__, ", ".join(items))
+    if isinstance(value, dict):
+        items = sorted(
+            "%s: %s" % (_describe_argument(k), _describe_argument(v))
+            for k, v in value.items()
+        )
+        return "dict(%s)" % ", ".join(items)
+    if isinstance(value, _EXACT_REPR_TYPES):
+        return "%s(%r)" % (type(value).__name__, value)
+    raise TypeError("Cannot memoize an argument of type %s" % type(value).__name__)
+
+
+def _code_digest(code):
+    # The bytecode and constants of a function and of the functions nested in
+    # it, so that editing the function invalidates its cached results.
+    digest = hashlib.sha256(code.co_code)
+    for constant in code.co_consts:
+        if hasattr(constant, "co_code"):
+            digest.update(_code_digest(constant).encode("utf-8"))
+        else:
+            digest.update(repr(constant).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _memo_key(func, args, kwargs):
+    code = getattr(inspect.unwrap(func), "__code__", None)
+    parts = [func.__module__, func.__qualname__]
+    parts.append("" if code is None else _code_digest(code))
+    parts += [_describe_argument(value) for value in args]
+    parts += [
+        "%s=%s" % (name, _describe_argument(kwargs[name])) for name in sorted(kwargs)
+    ]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def _result_bytes(result):
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return int(np.sum(result.memory_usage(deep=True)))
+    return len(pickle.dumps(result))
+
+
+def _copy(result):
+    # Cached results share no memory with the arguments or with the results
+    # returned, so modifying either never changes the cache.
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return result.copy()
+    return copy.deepcopy(result)
+
+
+def memoize(max_bytes=MEMO_MAX_BYTES, disk_dir=None):
+    """
+    Decorator caching the results of a preprocessing function, for use on
+    expensive steps, e.g. `memoize()(func)` or `@memoize()`.
+
+    Calls are keyed on the function's module, name and code (so that cached
+    results do not outlive edits to it), the `frame_fingerprint` of DataFrame
+    arguments (which hashes all their rows, so it costs a pass over the
+    data), a hash of the content of arrays and indexes and the `repr` of
+    scalars, and of lists, tuples and dicts of these. Other arguments raise
+    TypeError, since their `repr` may abbreviate or omit their content. Results are kept in memory
+    up to `max_bytes` in total, evicting the least recently used ones; with
+    `disk_dir` they are also pickled to that directory and reused from there
+    by later processes. The decorated function has `cache_info()`, returning
+    the hit and miss counters, and `cache_clear()`.
+
+    Results are copied into the cache and out of it, so modifying the data
+    passed in or the results returned never changes the cache.
+    """
+
+    def decorator(func):
+        cache = collections.OrderedDict()
+        counts = {"hits": 0, "disk_hits": 0, "misses": 0, "bytes": 0}
+
+        def store(key, result):
+            size = _result_bytes(result)
+            if size > max_bytes:
+                return
+            cache[key] = (result, size)
+            counts["bytes"] += size
+            while counts["bytes"] > max_bytes:
+                _, (_, evicted) = cache.popitem(last=False)
+                counts["bytes"] -= evicted
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = _memo_key(func, args, kwargs)
+            if key in cache:
+                counts["hits"] += 1
+                cache.move_to_end(key)
+                return _copy(cache[key][0])
+
+            path = None if disk_dir is None else os.path.join(disk_dir, key + ".pkl")
+            if path is not None and os.path.exists(path):
+                counts["disk_hits"] += 1
+                result = pd.read_pickle(path)
+            else:
+                counts["misses"] += 1
+                result = func(*args, **kwargs)
+                if path is not None:
+                    os.makedirs(disk_dir, exist_ok=True)
+                    fd, temporary = tempfile.mkstemp(dir=disk_dir, suffix=".tmp")
+                    os.close(fd)
+                    pd.to_pickle(result, temporary)
+                    os.replace(temporary, path)
+            store(key, _copy(result))
+            return result
+
+        def cache_info():
+            return MemoInfo(
+                counts["hits"],
+                counts["disk_hits"],
+                counts["misses"],
+                len(cache),
+                counts["bytes"],
+            )
+
+        def cache_clear():
+            cache.clear()
+            counts.update(hits=0, disk_hits=0, misses=0, bytes=0)
+
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        return wrapper
+
+    return decorator
+
+
+# Date layouts of the DataFrames passed to `subperiod_mobility_trends`, keyed
+# by `id()` and dropped when the DataFrame is garbage collected.
+_DATE_LAYOUTS = {}
+
+
+def _build_date_layout(dates):
+    """
+    Describe `dates` as runs of ascending dates (one run per region in the
+    Google report), or return None if they are not laid out that way.
+    """
+    if dates.dtype.kind != "M" or len(dates) == 0:
+        return None
+    days = dates.astype("datetime64[D]")
+    if np.isnat(days).any() or (days != dates).any():
+        return None
+    ordinals = days.view("int64")
+    run_starts = np.concatenate([[0], np.flatnonzero(ordinals[1:] < ordinals[:-1]) + 1])
+    if len(run_starts) > len(dates) // 8 + 1:
+        # Too many short runs: the dates are essentially unsorted.
+        return None
+    run_ids = np.repeat(
+        np.arange(len(run_starts)), np.diff(np.append(run_starts, len(dates)))
+    )
+    first = ordinals.min()
+    span = ordinals.max() - first + 2
+    # Offsetting each run by `run * span` makes the keys sorted overall, so
+    # one searchsorted call finds a window in every run at once.
+    return {
+        "keys": run_ids * span + (ordinals - first),
+        "runs": np.arange(len(run_starts)) * span,
+        "first": first,
+        "span": span,
+    }
+
+
+def _date_layout(data):
+    dates = data["date"].to_numpy()
+    signature = (len(dates), dates.__array_interface__["data"][0])
+    entry = _DATE_LAYOUTS.get(id(data))
+    if entry is None or entry["signature"] != signature:
+        entry = {"signature": signature, "layout": _build_date_layout(dates)}
+        if id(data) not in _DATE_LAYOUTS:
+            weakref.finalize(data, _DATE_LAYOUTS.pop, id(data), None)
+        _DATE_LAYOUTS[id(data)] = entry
+    return entry["layout"]
+
+
+def _window_positions(layout, start, end):
+    """
+    Return the start and end positions of the rows within [start, end] in
+    every run of `layout`.
+    """
+    start = min(max(start - layout["first"], 0), layout["span"] - 1)
+    end = min(max(end - layout["first"], -1), layout["span"] - 2)
+    lefts = np.searchsorted(layout["keys"], layout["runs"] + start, side="left")
+    rights = np.searchsorted(layout["keys"], layout["runs"] + end, side="right")
+    return lefts, rights
+
+
+def _take_ranges(data, lefts, rights):
+    """
+    Select the rows in the position ranges [lefts, rights) of `data`, as a
+    slice (without copying) when the ranges are contiguous.
+    """
+    keep = rights > lefts
+    lefts, rights = lefts[keep], rights[keep]
+    if len(lefts) == 0:
+        return data.iloc[0:0]
+    if (lefts[1:] == rights[:-1]).all():
+        return data.iloc[lefts[0] : rights[-1]]
+    return data.iloc[_range_positions(lefts, rights)]
+
+
+def _range_positions(lefts, rights):
+    """
+    Return the positions in the ranges [lefts, rights), in order.
+    """
+    lengths = np.maximum(rights - lefts, 0)
+    offsets = np.repeat(lefts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+@instrumented
 def subperiod_mobility_trends(data, start_date, end_date):
     """
     Add your mobility data in `data`.
 
     This function selects a subperiod of the mobility data based on prespecified start data and end date.
+
+    When the dates of `data` run in ascending order within each region, as in
+    the Google report, the subperiod is found by binary search in each run.
+    This layout is detected on the first call and reused on later calls with
+    the same DataFrame (do not modify its `date` column in place in between).
+    Other data is filtered row by row.
     """
-    mobility_trends = data[
-        data["date"].isin(pd.date_range(start=start_date, end=end_date))
-    ]
-    return mobility_trends
+    start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    layout = None
+    if start == start.normalize() and end == end.normalize():
+        layout = _date_layout(data)
+    if layout is None:
+        return data[data["date"].isin(pd.date_range(start=start_date, end=end_date))]
+
+    lefts, rights = _window_positions(
+        layout,
+        (start - pd.Timestamp(0)).days,
+        (end - pd.Timestamp(0)).days,
+    )
+    return _take_ranges(data, lefts, rights)
 
 
-def rename_mobility_trends(data):
+@instrumented
+def rename_mobility_trends(data, copy=True):
     """
     This function renames the column headings of the six mobility categories.
+
+    Pass `copy=False` to rename without copying the data (see `MobilitySchema.rename`).
     """
-    mobility_trends_renamed = data.rename(
-        columns={
-            "retail_and_recreation_percent_change_from_baseline": "Retail_Recreation",
-            "grocery_and_pharmacy_percent_change_from_baseline": "Grocery_Pharmacy",
-            "parks_percent_change_from_baseline": "Parks",
-            "transit_stations_percent_change_from_baseline": "Transit_stations",
-            "workplaces_percent_change_from_baseline": "Workplaces",
-            "residential_percent_change_from_baseline": "Residential",
-        }
-    )
+    mobility_trends_renamed = MOBILITY_SCHEMA.rename(data, copy=copy)
     return mobility_trends_renamed
+
+
+@instrumented
+def subperiods_mobility_trends(data, windows, column="window"):
+    """
+    Select several subperiods of the mobility data in `data` at once.
+
+    `windows` maps a label to a (start date, end date) pair, e.g.
+    `{"lockdown1": ("2020-03-24", "2020-04-13"), ...}` (a list of
+    `(label, (start_date, end_date))` pairs also works, as long as no label
+    repeats). Returns the rows of every window, window after window, with the
+    label of their window in a new categorical `column`; this is the same as
+    calling `subperiod_mobility_trends` for each window and concatenating the
+    results, but the dates are only scanned once: the windows are then looked
+    up by binary search.
+    """
+    items = list(windows.items() if isinstance(windows, dict) else windows)
+    windows = dict(items)
+    if len(windows) < len(items):
+        labels = [label for label, _ in items]
+        duplicates = sorted({label for label in labels if labels.count(label) > 1})
+        raise ValueError(
+            "Duplicate window labels: %s" % ", ".join(map(str, duplicates))
+        )
+    bounds = [(pd.Timestamp(a), pd.Timestamp(b)) for a, b in windows.values()]
+    labels = list(windows)
+
+    if all(a == a.normalize() and b == b.normalize() for a, b in bounds):
+        positions = _windows_positions(data, bounds)
+    else:
+        positions = None
+    if positions is None:
+        parts = [subperiod_mobility_trends(data, a, b) for a, b in bounds]
+        lengths = [len(part) for part in parts]
+        result = pd.concat(parts) if parts else data.iloc[0:0]
+    else:
+        lengths = [len(p) for p in positions]
+        result = data.iloc[np.concatenate(positions) if positions else []]
+
+    codes = np.repeat(np.arange(len(labels)), lengths)
+    result = result.copy()
+    result.insert(0, column, pd.Categorical.from_codes(codes, labels))
+    return result
+
+
+def _windows_positions(data, bounds):
+    """
+    Return the positions of the rows of `data` within each (start, end) pair
+    of `bounds`, or None if its date column is not of a datetime dtype.
+    """
+    day = pd.Timestamp(0)
+    bounds = [((a - day).days, (b - day).days) for a, b in bounds]
+    layout = _date_layout(data)
+    if layout is not None:
+        return [_range_positions(*_window_positions(layout, a, b)) for a, b in bounds]
+
+    # Unsorted dates: sort them once, then each window is a slice of the order.
+    dates = data["date"].to_numpy()
+    if dates.dtype.kind != "M":
+        return None
+    days = dates.astype("datetime64[D]")
+    candidates = np.flatnonzero(~np.isnat(days) & (days == dates))
+    ordinals = days.view("int64")[candidates]
+    order = np.argsort(ordinals, kind="stable")
+    ordinals = ordinals[order]
+    order = candidates[order]
+    positions = []
+    for a, b in bounds:
+        left = np.searchsorted(ordinals, a, side="left")
+        right = np.searchsorted(ordinals, b, side="right")
+        positions.append(np.sort(order[left:right]))
+    return positions
+
+
+def _id_column(values, repeats):
+    """
+    Repeat the id column `values` `repeats` times, as a categorical unless it
+    holds numbers or dates (which take no more room than codes).
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, categories = values.cat.codes.to_numpy(), values.cat.categories
+    elif values.dtype.kind in "biufcmM":
+        return np.tile(values.to_numpy(), repeats)
+    else:
+        codes, categories = pd.factorize(values)
+    return pd.Categorical.from_codes(np.tile(codes, repeats), categories)
+
+
+@instrumented
+def melt_mobility_trends(
+    data, id_vars=None, value_vars=None, var_name="variable", value_name="value"
+):
+    """
+    Reshape the mobility data in `data` from wide to long format, like
+    `pd.melt(data, id_vars, value_vars)`, but in a compact representation.
+
+    `variable` is a categorical, and text id columns (e.g. `country_region`)
+    are stored as categoricals too, so each repetition of an id costs a small
+    integer code instead of a copy of the string. The long frame is then no
+    bigger than the wide one. By default `value_vars` are the six mobility
+    categories and `id_vars` all other columns.
+    """
+    if value_vars is None:
+        value_vars = MOBILITY_SCHEMA.category_labels(data)
+    value_vars = list(value_vars)
+    if id_vars is None:
+        id_vars = [c for c in data.columns if c not in value_vars]
+    elif isinstance(id_vars, str):
+        id_vars = [id_vars]
+
+    repeats = len(value_vars)
+    columns = {column: _id_column(data[column], repeats) for column in id_vars}
+    columns[var_name] = pd.Categorical.from_codes(
+        np.repeat(np.arange(repeats), len(data)), value_vars
+    )
+    # Column after column, as `pd.melt` orders the rows.
+    columns[value_name] = np.concatenate(
+        [data[column].to_numpy() for column in value_vars]
+    )
+    return pd.DataFrame(columns)
@@ -0,0 +1,170 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from load_mobility_trends import (
+    file_fingerprint,
+    fingerprint_matches,
+    read_mobility_csv,
+)
+
+# Groups the missing values are counted for; the mobility categories are the
+# columns of the profile.
+GROUP_COLUMNS = ["country_region", "sub_region_1", "month"]
+
+
+class MissingProfile:
+    """
+    Missing values of the mobility data, counted in one pass.
+
+    `counts` has one row per country, sub_region_1 and month, with the number
+    of rows of that group (`rows`) and the number of missing values of each
+    column. Every missingness table of chapter 04 (per column, per country,
+    as counts or percentages) is a roll-up of this small table. The missing
+    values themselves are kept as one packed bitmask per column (one bit per
+    row), from which `isna` rebuilds any column's mask on demand.
+    """
+
+    def __init__(self, counts, masks, columns, n_rows):
+        self.counts = counts
+        self.masks = masks
+        self.columns = list(columns)
+        self.n_rows = n_rows
+
+    @classmethod
+    def build(cls, chunks):
+        """
+        Profile the mobility data given as an iterable of DataFrames (e.g.
+        the chunks of `read_mobility_csv(..., chunksize=...)`). Every chunk
+        but the last must have a multiple of 8 rows.
+        """
+        partials, masks, columns, n_rows = [], [], None, 0
+        for chunk in chunks:
+            if columns is None:
+                columns = list(chunk.columns)
+            missing = chunk.isna().to_numpy()
+            masks.append(np.packbits(missing.T, axis=1))
+            n_rows += len(chunk)
+
+            keys = chunk[GROUP_COLUMNS[:-1]].copy()
+            keys["month"] = chunk["date"].to_numpy().astype("datetime64[M]")
+            counts = pd.DataFrame(missing, columns=columns, index=chunk.index)
+            counts.insert(0, "rows", 1)
+            partials.append(
+                counts.groupby(
+                    [keys[column] for column in GROUP_COLUMNS],
+                    dropna=False,
+                    observed=True,
+                ).sum()
+            )
+
+        counts = pd.concat(partials).groupby(level=GROUP_COLUMNS, dropna=False).sum()
+        masks = np.concatenate(masks, axis=1) if masks else np.zeros((0, 0), np.uint8)
+        return cls(counts, masks, columns, n_rows)
+
+    def isna(self, column):
+        """
+        Return the boolean mask of the missing values of `column`.
+        """
+        bits = self.masks[self.columns.index(column)]
+        return np.unpackbits(bits, count=self.n_rows).astype(bool)
+
+    def missing(self, by=None, percent=False, **where):
+        """
+        Count the missing values of each column, like `data.isna().sum()`.
+
+        `by` lists group columns (of `GROUP_COLUMNS`) to count for each group,
+        and `where` restricts the count to some groups, e.g.
+        `missing(country_region="United Kingdom")`. With `percent=True` the
+        counts are divided by the number of rows and multiplied by 100.
+        """
+        counts = self.counts
+        for level, value in where.items():
+            counts = counts[counts.index.get_level_values(level) == value]
+        if by is None:
+            totals = counts.sum()
+            result = totals[self.columns]
+            return result / totals["rows"] * 100 if percent else result
+        totals = counts.groupby(level=by, dropna=False).sum()
+        result = totals[self.columns]
+        return result.div(totals["rows"], axis=0) * 100 if percent else result
+
+    def save(self, path, **metadata):
+        """
+        Write the profile to the `.npz` file `path`, with `metadata`.
+        """
+        index = self.counts.index
+        keys = [
+            [
+                None if pd.isna(value) else value
+                for value in index.get_level_values(level)
+            ]
+            for level in GROUP_COLUMNS[:-1]
+        ]
+        np.savez(
+            path,
+            metadata=np.array(
+                json.dumps(dict(metadata, n_rows=self.n_rows, columns=self.columns))
+            ),
+            keys=np.array(json.dumps(keys)),
+            months=index.get_level_values("month").to_numpy().astype("datetime64[M]"),
+            counts=self.counts.to_numpy(),
+            masks=self.masks,
+        )
+
+    @classmethod
+    def open(cls, path):
+        """
+        Read the profile saved in the `.npz` file `path`, and its metadata.
+        """
+        with np.load(path) as arrays:
+            metadata = json.loads(str(arrays["metadata"]))
+            keys = json.loads(str(arrays["keys"]))
+            index = pd.MultiIndex.from_arrays(
+                keys + [arrays["months"].astype("datetime64[ns]")], names=GROUP_COLUMNS
+            )
+            counts = pd.DataFrame(
+                arrays["counts"], index=index, columns=["rows"] + metadata["columns"]
+            )
+            profile = cls(
+                counts, arrays["masks"], metadata["columns"], metadata["n_rows"]
+            )
+        return profile, metadata
+
+
+def _missing_profile_path(source):
+    return source + ".missing.npz"
+
+
+def profile_missing(data, chunksize=1 << 18):
+    """
+    Profile the missing values of the mobility data in the DataFrame `data`,
+    `chunksize` rows at a time (see `MissingProfile`).
+    """
+    chunksize -= chunksize % 8
+    return MissingProfile.build(
+        data.iloc[start : start + chunksize] for start in range(0, len(data), chunksize)
+    )
+
+
+def load_missing_profile(source, sha256=None, chunksize=1 << 18):
+    """
+    Return the missing-value profile of the mobility report CSV at `source`.
+
+    The profile is computed in one streaming pass over the file and saved
+    next to it; later calls reuse it while the file is unchanged (see
+    `fingerprint_matches`).
+    """
+    path = _missing_profile_path(source)
+    if os.path.exists(path):
+        profile, metadata = MissingProfile.open(path)
+        matches, sha256 = fingerprint_matches(source, metadata, sha256)
+        if matches:
+            return profile
+
+    chunksize -= chunksize % 8
+    profile = MissingProfile.build(read_mobility_csv(source, chunksize=chunksize))
+    profile.save(path, **file_fingerprint(source, sha256))
+    return profile
@@ -0,0 +1,376 @@
+import os
+
+import pandas as pd
+
+from load_mobility_trends import STORE_DIR, iter_mobility_trends, load_mobility
+from preprocess_mobility_trends import (
+    MOBILITY_SCHEMA,
+    melt_mobility_trends,
+    subperiod_mobility_trends,
+)
+
+# Aggregations that can be computed chunk by chunk from partial results.
+_AGGREGATIONS = {
+    "mean": ["sum", "count"],
+    "sum": ["sum"],
+    "count": ["count"],
+    "min": ["min"],
+    "max": ["max"],
+}
+
+
+class MobilityQuery:
+    """
+    Lazy query over the mobility data.
+
+    Each method records a step and returns a new query; nothing is read until
+    `collect()`. The steps are then combined into a single plan: the date
+    window, the countries and the column projection are pushed down into the
+    loader, and filtering, aggregation and reshaping run in one pass. For
+    example, the mean mobility of each UK county during a lockdown is
+
+        MobilityQuery().window("2021-01-06", "2021-01-26")
+                       .countries(["United Kingdom"])
+                       .rename()
+                       .groupby("sub_region_1")
+                       .mean()
+                       .collect()
+
+    `source` is the data to query: a DataFrame, the path of a mobility report
+    CSV (read in chunks) or of a partitioned store (see `load_mobility`). By
+    default the partitioned store of the cached report is used.
+    """
+
+    def __init__(self, source=None, steps=()):
+        self.source = source
+        self.steps = tuple(steps)
+
+    def _add(self, *step):
+        return MobilityQuery(self.source, self.steps + (step,))
+
+    def window(self, start_date, end_date):
+        """
+        Keep the days from `start_date` to `end_date` (both included).
+        """
+        return self._add("window", pd.Timestamp(start_date), pd.Timestamp(end_date))
+
+    def countries(self, countries):
+        """
+        Keep the countries in `countries` (a name or a list of names).
+        """
+        if isinstance(countries, str):
+            countries = [countries]
+        return self._add("countries", frozenset(countries))
+
+    def where(self, **values):
+        """
+        Keep the rows whose columns equal the given values, e.g.
+        `where(sub_region_1="Essex")`.
+        """
+        return self._add("where", tuple(sorted(values.items())))
+
+    def categories(self, categories):
+        """
+        Keep only the mobility categories in `categories` (raw or short names).
+        """
+        return self._add("categories", tuple(categories))
+
+    def columns(self, columns):
+        """
+        Also return the columns in `columns` (e.g. `["sub_region_1", "date"]`).
+        """
+        return self._add("columns", tuple(columns))
+
+    def rename(self):
+        """
+        Give the mobility categories their short names (see `MOBILITY_SCHEMA`).
+        """
+        return self._add("rename")
+
+    def groupby(self, keys):
+        """
+        Group the rows by the columns in `keys` for the next aggregation.
+        """
+        if isinstance(keys, str):
+            keys = [keys]
+        return self._add("groupby", tuple(keys))
+
+    def agg(self, func):
+        """
+        Aggregate the categories of each group with `func`, one of "mean",
+        "sum", "count", "min" or "max".
+        """
+        if func not in _AGGREGATIONS:
+            raise ValueError("Unsupported aggregation: %r" % (func,))
+        return self._add("agg", func)
+
+    def mean(self):
+        """
+        Shorthand for `agg("mean")`.
+        """
+        return self.agg("mean")
+
+    def sum(self):
+        """
+        Shorthand for `agg("sum")`.
+        """
+        return self.agg("sum")
+
+    def count(self):
+        """
+        Shorthand for `agg("count")`.
+        """
+        return self.agg("count")
+
+    def min(self):
+        """
+        Shorthand for `agg("min")`.
+        """
+        return self.agg("min")
+
+    def max(self):
+        """
+        Shorthand for `agg("max")`.
+        """
+        return self.agg("max")
+
+    def melt(self):
+        """
+        Return the result in long format, with one `variable`/`value` row per
+        category.
+        """
+        return self._add("melt")
+
+    def plan(self):
+        """
+        Combine the recorded steps into a single plan (a dictionary).
+        """
+        plan = {
+            "start_date": None,
+            "end_date": None,
+            "countries": None,
+            "where": {},
+            "categories": None,
+            "columns": [],
+            "rename": False,
+            "groupby": None,
+            "agg": None,
+            "melt": False,
+        }
+        # Categories are resolved to the labels they have in the source (raw
+        # names, or short names in a renamed DataFrame).
+        if isinstance(self.source, pd.DataFrame):
+            source_labels = MOBILITY_SCHEMA.category_labels(self.source)
+        else:
+            source_labels = MOBILITY_SCHEMA.category_columns
+        labels = {_raw_name(label): label for label in source_labels}
+        for step in self.steps:
+            op, args = step[0], step[1:]
+            if op == "window":
+                # Successive windows intersect.
+                start, end = args
+                if plan["start_date"] is None or start > plan["start_date"]:
+                    plan["start_date"] = start
+                if plan["end_date"] is None or end < plan["end_date"]:
+                    plan["end_date"] = end
+            elif op == "countries":
+                countries = args[0]
+                if plan["countries"] is not None:
+                    countries = plan["countries"] & countries
+                plan["countries"] = countries
+            elif op == "where":
+                plan["where"].update(args[0])
+            elif op == "categories":
+                plan["categories"] = [
+                    labels.get(_raw_name(name), name) for name in args[0]
+                ]
+            elif op == "columns":
+                plan["columns"].extend(c for c in args[0] if c not in plan["columns"])
+            elif op == "groupby":
+                plan["groupby"] = list(args[0])
+            elif op in ("rename", "melt"):
+                plan[op] = True
+            else:
+                plan[op] = args[0]
+        if plan["categories"] is None:
+            plan["categories"] = list(labels.values())
+        if plan["agg"] is not None and plan["groupby"] is None:
+            plan["groupby"] = []
+        return plan
+
+    def explain(self):
+        """
+        Describe the plan that `collect()` will run.
+        """
+        plan = self.plan()
+        lines = ["scan %s" % _describe_source(self.source)]
+        lines.append("  read columns: %s" % ", ".join(_scan_columns(plan)))
+        if plan["start_date"] is not None:
+            lines.append(
+                "  pushed-down window: %s to %s"
+                % (plan["start_date"].date(), plan["end_date"].date())
+            )
+        if plan["countries"] is not None:
+            lines.append(
+                "  pushed-down countries: %s" % ", ".join(sorted(plan["countries"]))
+            )
+        for column, value in plan["where"].items():
+            lines.append("  filter: %s == %r" % (column, value))
+        if plan["agg"] is not None:
+            lines.append(
+                "aggregate %s by %s"
+                % (plan["agg"], ", ".join(plan["groupby"]) or "all rows")
+            )
+        if plan["melt"]:
+            lines.append("melt to long format")
+        return "\n".join(lines)
+
+    def collect(self):
+        """
+        Run the query and return the result as a DataFrame.
+        """
+        plan = self.plan()
+        source = self.source
+        if isinstance(source, pd.DataFrame):
+            result = _finish(_filter_frame(source, plan), plan)
+        elif source is None or os.path.isdir(source):
+            # `load_mobility` builds the default store on first use.
+            data = load_mobility(
+                plan["countries"], _scan_columns(plan), store_dir=source
+            )
+            result = _finish(_filter_frame(data, plan), plan)
+        else:
+            result = _collect_csv(source, plan)
+        return _reshape(result, plan)
+
+
+def _raw_name(name):
+    return MOBILITY_SCHEMA.raw_names.get(name, name)
+
+
+def _describe_source(source):
+    if source is None:
+        return "partitioned store %s" % STORE_DIR
+    if isinstance(source, pd.DataFrame):
+        return "DataFrame (%d rows)" % len(source)
+    if os.path.isdir(source):
+        return "partitioned store %s" % source
+    return "CSV %s (in chunks)" % source
+
+
+def _output_columns(plan):
+    """
+    Return the columns of the rows the plan keeps (projection pushdown).
+    """
+    columns = list(plan["groupby"] or []) + list(plan["columns"])
+    columns += [c for c in plan["where"] if c not in columns]
+    if plan["agg"] is None and not plan["groupby"]:
+        # Rows are returned: keep the columns that identify them.
+        for column in ["country_region", "sub_region_1", "date"]:
+            if column not in columns:
+                columns.append(column)
+    return columns + [c for c in plan["categories"] if c not in columns]
+
+
+def _scan_columns(plan):
+    """
+    Return the columns the plan needs to read: its output columns and the
+    columns its pushed-down filters test.
+    """
+    columns = _output_columns(plan)
+    if plan["start_date"] is not None and "date" not in columns:
+        columns.append("date")
+    if plan["countries"] is not None and "country_region" not in columns:
+        columns.append("country_region")
+    return columns
+
+
+def _filter_frame(data, plan):
+    """
+    Apply the filters of `plan` to the in-memory DataFrame `data`.
+    """
+    if plan["start_date"] is not None:
+        data = subperiod_mobility_trends(data, plan["start_date"], plan["end_date"])
+    mask = None
+    if plan["countries"] is not None:
+        mask = data["country_region"].isin(plan["countries"])
+    for column, value in plan["where"].items():
+        condition = data[column] == value
+        mask = condition if mask is None else mask & condition
+    columns = _output_columns(plan)
+    if mask is None:
+        return data[columns]
+    return data.loc[mask, columns]
+
+
+def _finish(data, plan):
+    """
+    Aggregate (if requested) the filtered rows in `data`.
+    """
+    if plan["agg"] is None:
+        return data
+    categories = plan["categories"]
+    if not plan["groupby"]:
+        return getattr(data[categories], plan["agg"])().to_frame().T
+    grouped = data.groupby(plan["groupby"], observed=True)[categories]
+    return getattr(grouped, plan["agg"])()
+
+
+def _collect_csv(source, plan):
+    """
+    Run `plan` over the CSV at `source` in one streaming pass, combining
+    partial aggregates chunk by chunk instead of holding the matching rows.
+    """
+    chunks = iter_mobility_trends(
+        source,
+        plan["start_date"],
+        plan["end_date"],
+        plan["countries"],
+        _output_columns(plan),
+    )
+    partials = []
+    for chunk in chunks:
+        chunk = _filter_frame(chunk, dict(plan, start_date=None, countries=None))
+        if plan["agg"] is None:
+            partials.append(chunk)
+            continue
+        keys = plan["groupby"] or (lambda _: 0)
+        grouped = chunk.groupby(keys, observed=True)[plan["categories"]]
+        partials.append(grouped.agg(_AGGREGATIONS[plan["agg"]]))
+
+    if plan["agg"] is None:
+        if not partials:
+            return pd.DataFrame(columns=_output_columns(plan))
+        return pd.concat(partials)
+
+    categories = plan["categories"]
+    if not partials:
+        return pd.DataFrame(columns=categories)
+    combined = pd.concat(partials)
+    level = list(range(combined.index.nlevels))
+    how = {c: c[1] if c[1] in ("min", "max") else "sum" for c in combined}
+    combined = combined.groupby(level=level).agg(how)
+    if plan["agg"] == "mean":
+        result = pd.DataFrame(
+            {c: combined[(c, "sum")] / combined[(c, "count")] for c in categories}
+        )
+    else:
+        result = pd.DataFrame({c: combined[(c, plan["agg"])] for c in categories})
+    if not plan["groupby"]:
+        result = result.reset_index(drop=True)
+    return result
+
+
+def _reshape(result, plan):
+    """
+    Apply the naming and layout steps of `plan` to the result.
+    """
+    if plan["rename"]:
+        result = MOBILITY_SCHEMA.rename(result, copy=False)
+    if plan["melt"]:
+        categories = MOBILITY_SCHEMA.category_labels(result)
+        if plan["groupby"]:
+            result = result.reset_index()
+        ids = [c for c in result.columns if c not in categories]
+        result = melt_mobility_trends(result, ids, categories)
+    return result
@@ -0,0 +1,194 @@
+import numpy as np
+import pandas as pd
+
+from aggregate_mobility_trends import factorize_groups
+from cube_mobility_trends import REGION_COLUMNS
+from load_mobility_trends import DATE_ORDINAL_NA, date_ordinals
+from preprocess_mobility_trends import MOBILITY_SCHEMA
+
+ROLLING_STATISTICS = ["mean", "sum", "std", "min", "max", "count"]
+
+
+def _window_days(window):
+    # Whole days in `window`, given as a number of days or as e.g. "7D".
+    if isinstance(window, (int, np.integer)):
+        days = int(window)
+    else:
+        delta = pd.Timedelta(window)
+        days = delta.days
+        if delta != pd.Timedelta(days=days):
+            raise ValueError("Windows must be whole days: %r" % (window,))
+    if days < 1:
+        raise ValueError("Windows must span at least one day: %r" % (window,))
+    return days
+
+
+def _window_starts(codes, days, window):
+    """
+    Return the position of the first row of the window of each row (sorted by
+    region and date): the first row of the same region dated at most
+    `window - 1` days earlier.
+    """
+    if not len(days):
+        return np.zeros(0, np.intp)
+    # One run of keys per region, spaced so that no window reaches into the
+    # previous run.
+    first = days.min()
+    span = days.max() - first + window
+    keys = codes.astype(np.int64) * span + (days - first)
+    return np.searchsorted(keys, keys - (window - 1), side="left")
+
+
+def _window_sums(values, codes, starts):
+    """
+    Sum of each window `values[start:row + 1]`, and a bound of its rounding
+    error for non-negative `values`.
+
+    The sums are differences of cumulative sums restarting at each region,
+    so that their rounding error stays at the scale of one region's series.
+    """
+    n_regions = codes[-1] + 1 if len(codes) else 0
+    first = np.searchsorted(codes, np.arange(n_regions))[codes]
+    ranks = np.arange(len(codes)) - first
+    table = np.zeros((n_regions, ranks.max() + 2 if len(codes) else 1))
+    table[codes, ranks + 1] = values
+    sums = np.cumsum(table, axis=1)
+    ends = sums[codes, ranks + 1]
+    bounds = np.finfo(np.float64).eps * (ranks + 1) * ends
+    return ends - sums[codes, starts - first], bounds
+
+
+def _window_extremes(values, starts, ufunc):
+    """
+    Minimum (`np.minimum`) or maximum (`np.maximum`) of each window
+    `values[start:row + 1]`, from a sparse table: the extremes of the runs of
+    2**k values for every k, of which two cover any window. Empty windows
+    are given the row's own value.
+    """
+    starts = np.minimum(starts, np.arange(len(values)))
+    lengths = np.arange(1, len(values) + 1) - starts
+    levels = [values]
+    while lengths.size and 2 ** len(levels) <= lengths.max():
+        half = 2 ** (len(levels) - 1)
+        levels.append(ufunc(levels[-1][:-half], levels[-1][half:]))
+    # The largest k with 2**k <= length.
+    powers = np.frexp(np.maximum(lengths, 1))[1] - 1
+    result = np.empty(len(values))
+    for power in np.unique(powers):
+        rows = np.flatnonzero(powers == power)
+        level = levels[power]
+        result[rows] = ufunc(level[starts[rows]], level[rows + 1 - 2**power])
+    return result
+
+
+def _rolling_column(values, codes, starts, statistics, min_periods):
+    """
+    Compute `statistics` over the window `values[start:row + 1]` of each row
+    of `values`, sorted by region and date.
+    """
+    valid = ~np.isnan(values)
+    count, _ = _window_sums(valid.astype(np.float64), codes, starts)
+    enough = count >= min_periods
+    result = {}
+    if {"sum", "mean", "std"} & set(statistics):
+        # Deviations from the region mean keep the cumulative sums small.
+        filled = np.where(valid, values, 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            centre = np.bincount(codes, weights=filled) / np.bincount(
+                codes, weights=valid
+            )
+        centre = np.nan_to_num(centre)[codes]
+        deviations = np.where(valid, values - centre, 0)
+        sums, _ = _window_sums(deviations, codes, starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result["sum"] = sums + centre * count
+            result["mean"] = result["sum"] / count
+            if "std" in statistics:
+                squares, bounds = _window_sums(deviations**2, codes, starts)
+                residuals = squares - sums**2 / count
+                # Within rounding error of 0, e.g. for constant windows, where
+                # pandas gives exactly 0.
+                residuals[residuals <= 2 * bounds] = 0
+                result["std"] = np.sqrt(residuals / (count - 1))
+                result["std"][count < 2] = np.nan
+    for name, ufunc, fill in [
+        ("min", np.minimum, np.inf),
+        ("max", np.maximum, -np.inf),
+    ]:
+        if name in statistics:
+            series = np.where(valid, values, fill)
+            result[name] = _window_extremes(series, starts, ufunc)
+            result[name][count == 0] = np.nan
+    if "count" in statistics:
+        # As in pandas, counts need `min_periods` rows, values or not.
+        rows = np.arange(1, len(values) + 1) - starts
+        result["count"] = np.where(rows >= min_periods, count, np.nan)
+    return {
+        name: result[name]
+        if name == "count"
+        else np.where(enough, result[name], np.nan)
+        for name in statistics
+    }
+
+
+def rolling_mobility_trends(
+    data,
+    window=7,
+    statistics="mean",
+    columns=None,
+    min_periods=None,
+    by=REGION_COLUMNS,
+):
+    """
+    Compute rolling statistics of the mobility categories over the trailing
+    `window` days of each region's series, like
+    `data.groupby(by).rolling("7D", on="date")[columns].agg(statistics)`,
+    aligned to the rows of `data`.
+
+    `window` is a number of days or a string such as "7D"; the window of a
+    row holds the rows of its region dated in the `window` days up to its
+    date, so missing dates shorten windows rather than stretch them.
+    `statistics` is one of, or a list of, "mean", "sum", "std", "min", "max"
+    and "count". Missing values are skipped, and a window with fewer than
+    `min_periods` values (by default the number of days of `window`) gives
+    NaN. Rows without a date have empty windows.
+
+    The rows are sorted by region and date once and the first row of every
+    window is found by binary search, so that all regions are processed at
+    once: sums, means and standard deviations from cumulative sums
+    (standard deviations within rounding error of 0 are 0, as in pandas),
+    and minima and maxima from a sparse table of running extremes.
+
+    With a single statistic the result has the columns of `columns`;
+    otherwise its columns are (column, statistic) pairs.
+    """
+    single = isinstance(statistics, str)
+    statistics = [statistics] if single else list(statistics)
+    for name in statistics:
+        if name not in ROLLING_STATISTICS:
+            raise ValueError("Unknown rolling statistic: %r" % (name,))
+    if columns is None:
+        columns = MOBILITY_SCHEMA.category_labels(data)
+    window = _window_days(window)
+    if min_periods is None:
+        min_periods = window
+
+    codes, _, _ = factorize_groups(data, by, dropna=False)
+    days = date_ordinals(data["date"]).astype(np.int64)
+    order = np.lexsort((days, codes))
+    codes, days = codes[order], days[order]
+    # Rows without a date sort first in their region; keep them out of every
+    # window, including their own.
+    dated = days != DATE_ORDINAL_NA
+    days[~dated] = days[dated].min() - window if dated.any() else 0
+    starts = _window_starts(codes, days, window)
+    starts[~dated] = np.flatnonzero(~dated) + 1
+    results = {}
+    for column in columns:
+        values = data[column].to_numpy(np.float64, na_value=np.nan)[order]
+        computed = _rolling_column(values, codes, starts, statistics, min_periods)
+        for name in statistics:
+            aligned = np.empty(len(data))
+            aligned[order] = computed[name]
+            results[column if single else (column, name)] = aligned
+    return pd.DataFrame(results, index=data.index)
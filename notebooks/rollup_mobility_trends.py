@@ -0,0 +1,347 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from aggregate_mobility_trends import factorize_groups
+from cube_mobility_trends import REGION_COLUMNS
+from load_mobility_trends import (
+    DATE_ORDINAL_NA,
+    date_ordinals,
+    file_fingerprint,
+    fingerprint_matches,
+    read_mobility_csv,
+)
+from preprocess_mobility_trends import MOBILITY_SCHEMA
+
+# Aggregates kept for every group, period and category, and the statistics
+# derived from them.
+AGGREGATES = ["count", "sum", "sum_squares", "min", "max"]
+ROLLUP_STATISTICS = ["count", "sum", "mean", "std", "min", "max"]
+
+# Geography levels, from the coarsest; a level groups the rows by its column
+# and the columns of the coarser levels.
+GEOGRAPHY_LEVELS = REGION_COLUMNS
+TIME_GRAINS = ["day", "week", "month"]
+
+
+def _level_columns(level):
+    if level is None:
+        return []
+    return REGION_COLUMNS[: GEOGRAPHY_LEVELS.index(level) + 1]
+
+
+def _period_starts(days, grain):
+    """
+    Return the first day of the `grain` period of each of the day ordinals
+    `days`. Weeks start on Mondays.
+    """
+    if grain == "day":
+        return days
+    if grain == "week":
+        # 1970-01-01, day 0, was a Thursday (weekday 3).
+        return days - (days + 3) % 7
+    months = days.astype("datetime64[D]").astype("datetime64[M]")
+    return months.astype("datetime64[D]").astype(days.dtype)
+
+
+def _combine(keys, aggregates, by):
+    """
+    Combine the `aggregates` (arrays of rows × categories) of the rows of the
+    DataFrame `keys` over the groups of its columns `by`. Returns the index of
+    the groups and their aggregates.
+    """
+    if by:
+        codes, n_groups, index = factorize_groups(keys, by, dropna=False)
+    else:
+        codes, n_groups, index = np.zeros(len(keys), np.intp), 1, pd.RangeIndex(1)
+    order = np.argsort(codes, kind="stable")
+    starts = np.flatnonzero(np.diff(codes[order], prepend=-1))
+    combined = {}
+    for name in AGGREGATES:
+        values = aggregates[name]
+        if name in ("min", "max"):
+            # Sorted by group, each group is one segment of the rows.
+            ufunc, fill = (
+                (np.minimum, np.inf) if name == "min" else (np.maximum, -np.inf)
+            )
+            values = np.where(np.isnan(values), fill, values)
+            if len(values):
+                result = ufunc.reduceat(values[order], starts, axis=0)
+            else:
+                # No rows: no groups, or one empty group when `by` is empty.
+                result = np.full((n_groups, values.shape[1]), fill)
+            result[np.isinf(result)] = np.nan
+        else:
+            result = np.column_stack(
+                [
+                    np.bincount(codes, weights=column, minlength=n_groups)
+                    for column in values.T
+                ]
+            )
+        combined[name] = result.reshape(n_groups, values.shape[1])
+    return index, combined
+
+
+def _aggregate_frame(index, aggregates, categories):
+    # One column per (category, aggregate) pair.
+    values = np.stack([aggregates[name] for name in AGGREGATES], axis=2)
+    return pd.DataFrame(
+        values.reshape(len(index), len(categories) * len(AGGREGATES)),
+        index=index,
+        columns=pd.MultiIndex.from_product([categories, AGGREGATES]),
+    )
+
+
+def _rollup(table, by):
+    """
+    Combine the rows of the aggregate `table` over the groups of its index
+    levels `by`.
+    """
+    categories = list(table.columns.unique(0))
+    values = table.to_numpy().reshape(len(table), len(categories), len(AGGREGATES))
+    aggregates = {name: values[:, :, number] for number, name in enumerate(AGGREGATES)}
+    keys = table.index.to_frame(index=False)
+    return _aggregate_frame(*_combine(keys, aggregates, by), categories)
+
+
+def _statistics(table, statistics):
+    """
+    Derive `statistics` (of `ROLLUP_STATISTICS`) of each category from the
+    aggregate `table`.
+    """
+    results = {}
+    for category in table.columns.unique(0):
+        count, total, squares, low, high = (
+            table[(category, name)].to_numpy() for name in AGGREGATES
+        )
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = (squares - total**2 / count) / (count - 1)
+            computed = {
+                "count": count.astype(np.int64),
+                "sum": total,
+                "mean": total / count,
+                "std": np.where(count > 1, np.sqrt(np.maximum(variance, 0)), np.nan),
+                "min": low,
+                "max": high,
+            }
+        for name in statistics:
+            results[(category, name)] = computed[name]
+    return pd.DataFrame(results, index=table.index)
+
+
+class MobilityAggregates:
+    """
+    Materialised aggregates of the mobility data at several granularities.
+
+    `tables[(level, grain)]` holds, for each group of the geography `level`
+    (each country for "country_region", each sub_region_1 of each country
+    for "sub_region_1", ...) and each `grain` period ("day", "week" or
+    "month", labelled by its first day), the count, sum, sum of squares,
+    minimum and maximum of each category. These combine exactly over groups
+    and periods, so statistics at a coarser level, over a date window or
+    over the whole period are rolled up from the (small) tables without the
+    rows of the data.
+    """
+
+    def __init__(self, tables, categories, n_rows):
+        self.tables = tables
+        self.categories = list(categories)
+        self.n_rows = n_rows
+
+    @classmethod
+    def build(cls, chunks, levels=("country_region", "sub_region_1")):
+        """
+        Aggregate the mobility data given as an iterable of DataFrames (e.g.
+        the chunks of `read_mobility_csv(..., chunksize=...)`) at each of the
+        geography `levels` and each time grain. Rows without a date are left
+        out.
+        """
+        levels = sorted(levels, key=GEOGRAPHY_LEVELS.index)
+        by = _level_columns(levels[-1]) + ["date"]
+        partials, categories, n_rows = [], None, 0
+        for chunk in chunks:
+            if categories is None:
+                categories = MOBILITY_SCHEMA.category_labels(chunk)
+            n_rows += len(chunk)
+            days = date_ordinals(chunk["date"])
+            dated = days != DATE_ORDINAL_NA
+            keys = chunk.loc[dated, by[:-1]].reset_index(drop=True)
+            keys["date"] = days[dated]
+            values = chunk.loc[dated, categories].to_numpy(np.float64, na_value=np.nan)
+            valid = ~np.isnan(values)
+            filled = np.where(valid, values, 0)
+            aggregates = {
+                "count": valid.astype(np.float64),
+                "sum": filled,
+                "sum_squares": filled**2,
+                "min": values,
+                "max": values,
+            }
+            partials.append(
+                _aggregate_frame(*_combine(keys, aggregates, by), categories)
+            )
+
+        # The daily table of the finest level; every other table is rolled up
+        # from it.
+        finest = _rollup(pd.concat(partials), by)
+        tables = {}
+        for level in levels:
+            for grain in TIME_GRAINS:
+                keys = finest.index.to_frame(index=False)
+                keys["date"] = _period_starts(keys["date"].to_numpy(), grain)
+                table = finest.set_axis(pd.MultiIndex.from_frame(keys), axis=0)
+                table = _rollup(table, _level_columns(level) + ["date"])
+                days = table.index.levels[-1].to_numpy()
+                tables[(level, grain)] = table.set_axis(
+                    table.index.set_levels(
+                        days.astype("datetime64[D]").astype("datetime64[ns]"),
+                        level="date",
+                    ),
+                    axis=0,
+                )
+        return cls(tables, categories, n_rows)
+
+    def _source(self, level, grain):
+        # The table of `grain` at the coarsest materialised level at least as
+        # fine as `level`.
+        depth = -1 if level is None else GEOGRAPHY_LEVELS.index(level)
+        for source in sorted(
+            {key for key, _ in self.tables}, key=GEOGRAPHY_LEVELS.index
+        ):
+            if GEOGRAPHY_LEVELS.index(source) >= depth:
+                return self.tables[(source, grain)]
+        raise ValueError("No aggregates at or below the level %r" % (level,))
+
+    def query(
+        self,
+        level="country_region",
+        grain="day",
+        statistics="mean",
+        categories=None,
+        start_date=None,
+        end_date=None,
+        **where
+    ):
+        """
+        Return `statistics` of the mobility categories for each group of the
+        geography `level` (None for all the data) and each `grain` period
+        (None for the whole period), like
+        `data.groupby([*levels, period])[categories].agg(statistics)`.
+
+        `statistics` is one of, or a list of, "count", "sum", "mean", "std",
+        "min" and "max". The data can be restricted to the dates between
+        `start_date` and `end_date` (both included; with a week or month
+        `grain`, to the periods starting between them) and to the groups in
+        `where`, e.g. `query("sub_region_1", None, country_region="Italy")`
+        for the mean of each Italian region over the whole period.
+
+        With a single statistic the result has one column per category;
+        otherwise its columns are (category, statistic) pairs.
+        """
+        single = isinstance(statistics, str)
+        statistics = [statistics] if single else list(statistics)
+        for name in statistics:
+            if name not in ROLLUP_STATISTICS:
+                raise ValueError("Unknown statistic: %r" % (name,))
+        dated = start_date is not None or end_date is not None
+        table = self._source(level, grain or ("day" if dated else "month"))
+        if categories is not None:
+            table = table[categories]
+
+        keep = np.ones(len(table), dtype=bool)
+        for column, value in where.items():
+            keys = table.index.get_level_values(column)
+            keep &= keys.isna() if value is None else keys == value
+        dates = table.index.get_level_values("date")
+        if start_date is not None:
+            keep &= dates >= pd.Timestamp(start_date)
+        if end_date is not None:
+            keep &= dates <= pd.Timestamp(end_date)
+        table = table[keep]
+
+        by = _level_columns(level) + (["date"] if grain else [])
+        if by != list(table.index.names):
+            table = _rollup(table, by)
+        result = _statistics(table, statistics)
+        if single:
+            result.columns = result.columns.droplevel(1)
+        return result
+
+    def save(self, path, **metadata):
+        """
+        Write the aggregates to the `.npz` file `path`, with `metadata`.
+        """
+        arrays = {}
+        for number, (key, table) in enumerate(self.tables.items()):
+            index = table.index
+            keys = [
+                [
+                    None if pd.isna(value) else value
+                    for value in index.get_level_values(level)
+                ]
+                for level in index.names[:-1]
+            ]
+            arrays["keys_%d" % number] = np.array(json.dumps(keys))
+            arrays["dates_%d" % number] = (
+                index.get_level_values("date").to_numpy().astype("datetime64[D]")
+            )
+            arrays["values_%d" % number] = table.to_numpy()
+        metadata = dict(
+            metadata,
+            n_rows=self.n_rows,
+            categories=self.categories,
+            tables=list(self.tables),
+        )
+        np.savez(path, metadata=np.array(json.dumps(metadata)), **arrays)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Read the aggregates saved in the `.npz` file `path`, and their
+        metadata.
+        """
+        tables = {}
+        with np.load(path) as arrays:
+            metadata = json.loads(str(arrays["metadata"]))
+            columns = pd.MultiIndex.from_product([metadata["categories"], AGGREGATES])
+            for number, (level, grain) in enumerate(metadata["tables"]):
+                keys = json.loads(str(arrays["keys_%d" % number]))
+                index = pd.MultiIndex.from_arrays(
+                    keys + [arrays["dates_%d" % number].astype("datetime64[ns]")],
+                    names=_level_columns(level) + ["date"],
+                )
+                tables[(level, grain)] = pd.DataFrame(
+                    arrays["values_%d" % number], index=index, columns=columns
+                )
+        return cls(tables, metadata["categories"], metadata["n_rows"]), metadata
+
+
+def _aggregates_path(source):
+    return source + ".aggregates.npz"
+
+
+def load_mobility_aggregates(
+    source, sha256=None, levels=("country_region", "sub_region_1"), chunksize=1 << 18
+):
+    """
+    Return the `MobilityAggregates` of the mobility report CSV at `source`.
+
+    The aggregates are computed in one streaming pass over the file and saved
+    next to it; later calls reuse them while the file is unchanged (see
+    `fingerprint_matches`) and they cover `levels`.
+    """
+    path = _aggregates_path(source)
+    if os.path.exists(path):
+        aggregates, metadata = MobilityAggregates.open(path)
+        matches, sha256 = fingerprint_matches(source, metadata, sha256)
+        saved = {level for level, _ in aggregates.tables}
+        if matches and saved.issuperset(levels):
+            return aggregates
+
+    aggregates = MobilityAggregates.build(
+        read_mobility_csv(source, chunksize=chunksize), levels
+    )
+    aggregates.save(path, **file_fingerprint(source, sha256))
+    return aggregates
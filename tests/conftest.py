@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules under test live next to the notebooks.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "notebooks"))
@@ -0,0 +1,149 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+import load_mobility_trends
+from generate_mobility_trends import generate_mobility_report
+from load_mobility_trends import (
+    build_mobility_store,
+    load_mobility,
+    read_mobility_csv,
+    update_mobility_store,
+)
+
+KEYS = ["country_region", "sub_region_1", "sub_region_2", "metro_area", "date"]
+PARKS = "parks_percent_change_from_baseline"
+
+
+@pytest.fixture
+def report():
+    return generate_mobility_report(
+        countries=3, regions=2, sub_regions=1, end_date="2020-03-15"
+    )
+
+
+def write(data, path):
+    data.to_csv(path, index=False)
+    return str(path)
+
+
+def assert_store_equals(store_dir, source):
+    # Row labels of updated stores differ from the CSV's row numbers.
+    stored = load_mobility(store_dir=store_dir)
+    expected = read_mobility_csv(source)
+    stored = stored.sort_values(KEYS).reset_index(drop=True)
+    expected = expected.sort_values(KEYS).reset_index(drop=True)
+    pd.testing.assert_frame_equal(stored[expected.columns], expected, check_dtype=False)
+
+
+def store_files(store_dir):
+    return sorted(
+        os.path.relpath(os.path.join(root, name), store_dir)
+        for root, _, names in os.walk(store_dir)
+        for name in names
+    )
+
+
+def test_appended_day(report, tmp_path):
+    last_day = report["date"] == report["date"].max()
+    store_dir = build_mobility_store(
+        write(report[~last_day], tmp_path / "old.csv"), tmp_path / "store"
+    )
+    source = write(report, tmp_path / "new.csv")
+    changes = update_mobility_store(source, store_dir)
+    assert changes == {
+        "appended_rows": last_day.sum(),
+        "added": [],
+        "rewritten": [],
+        "removed": [],
+    }
+    assert_store_equals(store_dir, source)
+
+
+def test_revised_row(report, tmp_path):
+    store_dir = build_mobility_store(
+        write(report, tmp_path / "old.csv"), tmp_path / "store"
+    )
+    revised = report.copy()
+    revised.loc[10, PARKS] = 999
+    source = write(revised, tmp_path / "new.csv")
+    changes = update_mobility_store(source, store_dir)
+    assert changes["rewritten"] == [report.loc[10, "country_region"]]
+    assert changes["appended_rows"] == 0
+    assert_store_equals(store_dir, source)
+
+
+def test_removed_country(report, tmp_path):
+    store_dir = build_mobility_store(
+        write(report, tmp_path / "old.csv"), tmp_path / "store"
+    )
+    country = report["country_region"].iloc[-1]
+    source = write(report[report["country_region"] != country], tmp_path / "new.csv")
+    changes = update_mobility_store(source, store_dir)
+    assert changes["removed"] == [country]
+    assert_store_equals(store_dir, source)
+    assert not any(country in path for path in store_files(store_dir))
+
+
+def test_no_op_update(report, tmp_path):
+    source = write(report, tmp_path / "report.csv")
+    store_dir = build_mobility_store(source, tmp_path / "store")
+    files = store_files(store_dir)
+    changes = update_mobility_store(source, store_dir)
+    assert changes == {"appended_rows": 0, "added": [], "rewritten": [], "removed": []}
+    assert store_files(store_dir) == files
+    assert_store_equals(store_dir, source)
+
+
+def test_interrupted_update_leaves_store_readable(report, tmp_path, monkeypatch):
+    old = write(report, tmp_path / "old.csv")
+    store_dir = build_mobility_store(old, tmp_path / "store")
+    revised = report.copy()
+    revised.loc[10, PARKS] = 999
+    source = write(revised, tmp_path / "new.csv")
+
+    def crash(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    # Interrupted while rewriting the revised country.
+    with monkeypatch.context() as patch:
+        patch.setattr(load_mobility_trends, "_write_partitions", crash)
+        with pytest.raises(KeyboardInterrupt):
+            update_mobility_store(source, store_dir)
+    assert_store_equals(store_dir, old)
+
+    update_mobility_store(source, store_dir)
+    assert_store_equals(store_dir, source)
+
+
+def test_compaction(report, tmp_path, monkeypatch):
+    monkeypatch.setattr(load_mobility_trends, "MAX_PARTS", 2)
+    dates = sorted(report["date"].unique())
+    store_dir = build_mobility_store(
+        write(report[report["date"] <= dates[-4]], tmp_path / "0.csv"),
+        tmp_path / "store",
+    )
+    for number, date in enumerate(dates[-3:], 1):
+        source = write(report[report["date"] <= date], tmp_path / ("%d.csv" % number))
+        update_mobility_store(source, store_dir)
+        assert_store_equals(store_dir, source)
+
+    with open(os.path.join(store_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    listed = sorted(
+        os.path.join(partition["path"], part)
+        for partition in manifest["partitions"]
+        for part in partition["parts"]
+    )
+    assert all(len(p["parts"]) <= 2 for p in manifest["partitions"])
+    assert [f for f in store_files(store_dir) if f != "manifest.json"] == listed
+
+
+def test_load_keeps_column_order(report, tmp_path):
+    source = write(report, tmp_path / "report.csv")
+    store_dir = build_mobility_store(source, tmp_path / "store")
+    columns = [PARKS, "date", "unknown", "country_region"]
+    data = load_mobility(columns=columns, store_dir=store_dir)
+    assert list(data.columns) == [PARKS, "date", "country_region"]